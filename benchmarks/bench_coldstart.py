@@ -0,0 +1,70 @@
+#cold start benchmark for the gcalwatch service: each run is a fresh interpreter
+#that imports gcalwatch, serves a first (sync) webhook request and
+#then imports the client libraries deferred to the first notification (prewarm)
+#run from the repository root: python benchmarks/bench_coldstart.py [--json]
+#--json prints a single JSON line with the medians, to be collected over time
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT=os.path.join(os.path.dirname(os.path.abspath(__file__)),"..")
+RUNS=7
+
+#runs in the child interpreter, prints the timings in ms as JSON
+CHILD="""
+import json,time
+start=time.perf_counter()
+import gcalwatch
+imported=time.perf_counter()
+from werkzeug.test import EnvironBuilder
+#plain WSGI call, the Flask test client does not support every Werkzeug version
+environ=EnvironBuilder(method="POST",path="/webhook",
+                       headers={"X-Goog-Channel-Id":gcalwatch.WATCH_ID+"-bench",
+                                "X-Goog-Resource-State":"sync"}).get_environ()
+statuses=[]
+body=b"".join(gcalwatch.app(environ,lambda status,headers,exc_info=None: statuses.append(status)))
+assert statuses[0].startswith("200"),statuses
+served=time.perf_counter()
+import google.auth,google.cloud.storage,google.cloud.pubsub_v1,gcalservice,eventsync
+deferred=time.perf_counter()
+print(json.dumps({"import_ms":(imported-start)*1000,
+                  "first_request_ms":(served-imported)*1000,
+                  "deferred_imports_ms":(deferred-served)*1000}))
+"""
+
+
+def run_once():
+    env = dict(os.environ)
+    #background prewarm would overlap with the measured phases
+    env["GCALWATCH_PREWARM"]="0"
+    env["PYTHONDONTWRITEBYTECODE"]="1"
+    output = subprocess.run([sys.executable,"-c",CHILD],cwd=ROOT,env=env,
+                            capture_output=True,text=True,check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values)//2]
+
+
+def main():
+    runs = [run_once() for i in range(RUNS)]
+    result = {key:round(median([run[key] for run in runs]),1) for key in runs[0]}
+    result["ready_ms"]=round(result["import_ms"]+result["first_request_ms"],1)
+    #what a request paid before, when everything was imported with gcalwatch
+    result["eager_ms"]=round(result["ready_ms"]+result["deferred_imports_ms"],1)
+    if "--json" in sys.argv:
+        result["timestamp"]=int(time.time())
+        result["python"]=sys.version.split()[0]
+        print(json.dumps(result))
+        return
+    print("median of "+str(RUNS)+" runs, ms")
+    for key in ["import_ms","first_request_ms","ready_ms","deferred_imports_ms","eager_ms"]:
+        print("{:<22}{:>10}".format(key,result[key]))
+
+
+if __name__ == '__main__':
+    main()
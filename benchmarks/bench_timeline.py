@@ -0,0 +1,179 @@
+#microbenchmark: room status lookup from raw events (get_calendar_status_from_events,
+#the computation GCalClient used before EventTimeline) versus the precompiled
+#EventTimeline used by CalendarMap and GCalClient
+#run from the repository root: python benchmarks/bench_timeline.py
+import os
+import sys
+import random
+import timeit
+from datetime import datetime,timezone,timedelta
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+
+from roomstatus import RoomStatus
+from timeline import EventTimeline
+
+SIZES=[10,100,1000]
+REPEAT=5
+
+
+######## baseline, parses the raw events on every lookup
+
+def set_nextev_dates(startd,endd,tomorrow,result):
+    #utility to set next events dates in right format
+    #if it's within the day use only H:M otherwise put day in front
+    if (startd<tomorrow):
+        result.nextevstart = datetime.strftime(startd,"%H:%M")
+        result.nextevend = datetime.strftime(endd,"%H:%M")
+        result.nextevtm=result.nextevstart+"-"+result.nextevend
+    else: 
+        enddayofmonth = datetime.strftime(endd,"%Y-%m-%d")
+        startdayofmonth=datetime.strftime(startd,"%Y-%m-%d")
+        if (enddayofmonth!=startdayofmonth):
+            #this is a multi-day event
+            #and it is in progress, hence the current day is
+            #fully busy
+            result.nextevend = datetime.strftime(endd,"%b %d")
+            result.nextevstart = datetime.strftime(startd,"%b %d")
+            result.nextevtm = result.nextevstart+"-"+result.nextevend
+        else:
+            result.nextevstart = datetime.strftime(startd,"%Y-%m-%d %H:%M")
+            result.nextevend = datetime.strftime(endd,"%H:%M")
+            result.nextevtm = datetime.strftime(startd,"%a %d %b %H:%M") \
+                            +"-"+result.nextevend
+
+
+def get_calendar_status_from_events(room_name,events):
+    result = RoomStatus()
+    result.valid = True
+    result.name=room_name
+
+    if not events:
+        return result
+
+    # Fetches the first 2 events
+    evno = 0
+    eventid = ""
+    for event in events:
+        organizer = ""
+        start = event['start'].get('dateTime', event['start'].get('date'))
+        end = event['end'].get('dateTime', event['end'].get('date'))
+        status='confirmed'
+        if 'attendees' in event:
+            attendees = event['attendees']
+            for attendee in attendees:
+                #look for the attendee with key 'self' which
+                #is the owner of this calendar
+                #and check if it was accepted
+                if 'self' in attendee:
+                    status = attendee['responseStatus']
+                if "organizer" in attendee and attendee["organizer"] is True:
+                    organizer = attendee["email"]
+        eventid = event['id']
+        summary = "Private Meeting"
+        if "summary" in event:
+                summary = event["summary"]
+
+        startd=datetime.strptime(start,"%Y-%m-%dT%H:%M:%S%z")
+        endd=datetime.strptime(end,"%Y-%m-%dT%H:%M:%S%z")
+
+        if endd<=datetime.now(timezone.utc):
+            #cached events can be older than the event itself, skip it
+            #or the room would look busy until the next download
+            continue
+
+        tomorrow = datetime.now(timezone.utc) \
+                    .replace(hour=0, minute=0, second=0, microsecond=0) \
+                    + timedelta(days=1)
+
+        if status!='declined':
+            #we will count and consider only accepted events
+            evno = evno+1
+
+        if status!='declined' and evno==1:
+            #first event will tell if room is busy
+            #if started before now, event is current
+            if (startd<datetime.now(timezone.utc)):
+                result.busynow = RoomStatus.BUSY
+                result.curevmsg = summary
+                result.curevorganizer = organizer
+                result.curevid = eventid
+                enddayofmonth = datetime.strftime(endd,"%Y-%m-%d")
+                startdayofmonth=datetime.strftime(startd,"%Y-%m-%d")
+                if (enddayofmonth!=startdayofmonth):
+                    #this is a multi-day event
+                    #and it is in progress, hence the current day is
+                    #fully busy
+                    result.curevend = datetime.strftime(endd,"%b %d")
+                    result.curevstart = datetime.strftime(startd,"%b %d")
+                    result.curevtm = result.curevstart+"-"+result.curevend
+                else:
+                    result.curevend = datetime.strftime(endd,"%H:%M")
+                    result.curevstart = datetime.strftime(startd,"%H:%M")
+                    result.curevtm = result.curevstart+"-"+result.curevend
+            else:
+                #didn't start before now. will it start today ? 
+                #if starts today, calculate free until time
+                result.busynow = RoomStatus.FREE
+                if (startd<tomorrow):
+                    result.curevmsg = "Free until "+datetime.strftime(startd,"%H:%M")
+                else: 
+                    #else is free all day
+                    result.curevmsg = "Free all day"
+
+                #sets next events details
+                set_nextev_dates(startd,endd,tomorrow,result)
+                result.nextevmsg = summary
+                result.nextevorganizer=organizer 
+                result.nextevid = eventid
+
+        if status!='declined' and evno==2:
+            #second event is useful only if room is busy to set next mtg details
+            if result.busynow==RoomStatus.BUSY:
+                result.nextevmsg = summary
+                result.nextevid = eventid 
+                set_nextev_dates(startd,endd,tomorrow,result)
+                result.nextevorganizer=organizer 
+
+    return result
+
+
+def make_events(count,seed=1):
+    rnd = random.Random(seed)
+    now = datetime.now(timezone.utc).replace(second=0,microsecond=0)
+    start = now-timedelta(minutes=30)
+    tz = timezone(timedelta(hours=1))
+    events=[]
+    for i in range(count):
+        end = start+timedelta(minutes=rnd.choice([15,30,60,90]))
+        event = {
+            "id":"ev"+str(i),
+            "summary":"Meeting "+str(i),
+            "start":{"dateTime":start.astimezone(tz).strftime("%Y-%m-%dT%H:%M:%S%z")},
+            "end":{"dateTime":end.astimezone(tz).strftime("%Y-%m-%dT%H:%M:%S%z")},
+            "attendees":[
+                {"email":"organizer"+str(i)+"@example.com","organizer":True,"responseStatus":"accepted"},
+                {"email":"room@example.com","self":True,"responseStatus":rnd.choice(["accepted","accepted","declined"])}
+            ]
+        }
+        events.append(event)
+        start = end+timedelta(minutes=rnd.choice([0,15,60]))
+    return events
+
+
+def main():
+    print("events  raw_us/lookup  compile_us  timeline_us/lookup  speedup")
+    for size in SIZES:
+        events = make_events(size)
+        timeline = EventTimeline.from_events(events)
+        if get_calendar_status_from_events("bench_room",events)!=timeline.status_at("bench_room"):
+            print("WARNING: results differ for size "+str(size))
+        number = max(1,20000//size)
+        raw = min(timeit.repeat(lambda: get_calendar_status_from_events("bench_room",events),number=number,repeat=REPEAT))/number
+        compile_time = min(timeit.repeat(lambda: EventTimeline.from_events(events),number=max(1,number//10),repeat=REPEAT))/max(1,number//10)
+        lookup = min(timeit.repeat(lambda: timeline.status_at("bench_room"),number=number*10,repeat=REPEAT))/(number*10)
+        print("%6d  %13.1f  %10.1f  %18.2f  %7.0fx" % (size,raw*1e6,compile_time*1e6,lookup*1e6,raw/lookup))
+
+
+if __name__ == '__main__':
+    main()
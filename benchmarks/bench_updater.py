@@ -0,0 +1,240 @@
+#offline throughput benchmark of updater: watch_and_update_iot runs against the
+#in-process fakes of benchmarks/fakes.py (Calendar, IoT Cloud, Pub/Sub, GCS),
+#one fresh interpreter per room count. For each size it reports
+# - startup: time until the receiver is subscribed (initial download and watch)
+# - cold tick: first reconcile of all rooms, IoT properties all out of date
+# - steady tick: reconcile of all rooms already in sync
+# - changes: a burst of calendar changes published like gcalwatch does, end to
+#   end latency from publish to the room in sync in IoT
+#run from the repository root: python benchmarks/bench_updater.py [--sizes 10,100,1000] [--json]
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT=os.path.join(os.path.dirname(os.path.abspath(__file__)),"..")
+sys.path.insert(0,ROOT)
+sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+
+TICK_TIMEOUT=900  #secs
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Offline updater benchmark")
+    parser.add_argument("--sizes",default="10,100,1000",help="comma separated room counts")
+    parser.add_argument("--events",type=int,default=20,help="events per room calendar")
+    parser.add_argument("--changes",type=int,default=50,help="rooms changed in the change burst")
+    parser.add_argument("--room-workers",type=int,default=4)
+    parser.add_argument("--iot-latency-ms",type=float,default=5)
+    parser.add_argument("--iot-rps",type=float,default=1000,help="fake IoT Cloud rate limit")
+    parser.add_argument("--iot-burst",type=int,default=100)
+    parser.add_argument("--iot-propagation-ms",type=float,default=0,help="delay before written values are read back")
+    parser.add_argument("--client-rps",type=float,default=800,help="iot_rate_limit_rps of the updater")
+    parser.add_argument("--client-burst",type=int,default=50,help="iot_rate_limit_burst of the updater")
+    parser.add_argument("--calendar-latency-ms",type=float,default=20)
+    parser.add_argument("--json",action="store_true",help="print one JSON line per size")
+    parser.add_argument("--child",type=int,default=0,help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def run_child(args):
+    #runs in a fresh interpreter: class level caches of the updater modules
+    #(CalendarMap, ThingIndex, RateLimiter, ...) start empty for every size
+    import logging
+    import queue
+    from types import SimpleNamespace
+    import requests
+    import fakes
+    import gcalclient
+    import iotclient
+    import receiver_task
+    import tokenmanager
+    import updater
+    from calendarmap import CalendarMap
+    from wireformat import encode_room_events,ATTR_NOTIFIED
+
+    logging.disable(logging.INFO)
+    log = fakes.CallLog()
+    calendar = fakes.FakeCalendar(log,args.calendar_latency_ms/1000.0)
+    iot = fakes.FakeIotCloud(log,args.iot_latency_ms/1000.0,args.iot_rps,args.iot_burst,args.iot_propagation_ms/1000.0)
+    pubsub = fakes.FakePubSub(log)
+    storage = fakes.FakeStorage(log)
+
+    room_names = ["room%04d" % i for i in range(args.child)]
+    calendar_ids = {room_name:room_name+"@resource.calendar.example.com" for room_name in room_names}
+    for i,room_name in enumerate(room_names):
+        calendar.add_calendar(calendar_ids[room_name],fakes.make_room_events(args.events,seed=i))
+        iot.add_thing(room_name)
+    storage.put_json(updater.BUCKET_NAME,"config.json",{
+        "iot_client_id":"bench","iot_client_secret":"bench",
+        "gcal_watch_function_url":"http://gcalwatch.invalid",
+        "iot_rate_limit_rps":args.client_rps,"iot_rate_limit_burst":args.client_burst,
+        "room_workers":args.room_workers,"metrics_port":0,
+        "rooms":[{"room_name":room_name,"gcal_calendar_id":calendar_ids[room_name]} for room_name in room_names]
+    })
+
+    #gcalwatch endpoints called by updater answer as if all watches succeeded
+    class FakeResponse:
+        def __init__(self,body):
+            self.body=body
+            self.text=json.dumps(body)
+        def raise_for_status(self):
+            return
+        def json(self):
+            return self.body
+    def post(url,json=None,headers=None):
+        log.count("gcalwatch",url.rsplit("/",1)[-1])
+        return FakeResponse({room_name:{"status":"ok"} for room_name in (json or {}).get("room_names",[])})
+
+    subscription = "projects/bench-project/subscriptions/roomcalendar_events-sub"
+    topic = "projects/bench-project/topics/roomcalendar_events"
+    def receiver(cm):
+        #the real callback without the minute ticks, ticks are pushed below
+        receiver_task.calendar_map = cm
+        pubsub.subscribe(subscription,receiver_task.callback)
+
+    ticks = queue.Queue()
+    process_rooms = updater.process_rooms
+    def recording_process_rooms(cm,iotc,names,executor=None):
+        before = log.snapshot()
+        start = time.time()
+        failed = process_rooms(cm,iotc,names,executor)
+        after = log.snapshot()
+        ticks.put({"rooms":len(names),"failed":len(failed),"secs":time.time()-start,
+                   "iot_calls":fakes.CallLog.diff(after,before,"iot"),
+                   "calendar_calls":fakes.CallLog.diff(after,before,"calendar")})
+        return failed
+
+    synced = queue.Queue()
+    process_room = updater.process_room
+    def recording_process_room(cm,iotc,room_name):
+        result = process_room(cm,iotc,room_name)
+        synced.put((room_name,time.time(),result))
+        return result
+
+    gcalclient.get_calendar_service = lambda: calendar
+    iotclient.thingApi = SimpleNamespace(ThingsV2Api=iot.things_api)
+    iotclient.propertiesApi = SimpleNamespace(PropertiesV2Api=iot.properties_api)
+    tokenmanager.OAuth2Session = fakes.FakeOAuth2Session
+    updater.storage = storage.module()
+    updater.get_credentials = fakes.fake_credentials
+    updater.requests = SimpleNamespace(post=post,RequestException=requests.RequestException,
+                                       HTTPError=requests.HTTPError)
+    updater.receiver_task = receiver
+    updater.process_rooms = recording_process_rooms
+    updater.process_room = recording_process_room
+
+    result = {"rooms":args.child}
+    start = time.time()
+    before = log.snapshot()
+    from threading import Thread
+    thread = Thread(target=updater.watch_and_update_iot,daemon=True)
+    thread.name = "updater"
+    thread.start()
+    while pubsub.subscriber_count()==0:
+        time.sleep(0.01)
+    after = log.snapshot()
+    result["startup_secs"]=round(time.time()-start,3)
+    result["startup_calendar_calls"]=fakes.CallLog.diff(after,before,"calendar")
+
+    def tick():
+        CalendarMap().pushWakeup(CalendarMap.REASON_REGULAR,"")
+        return ticks.get(timeout=TICK_TIMEOUT)
+
+    #all rooms were woken by the startup
+    cold = tick()
+    result["cold_tick_secs"]=round(cold["secs"],3)
+    result["cold_rooms_per_min"]=round(cold["rooms"]/max(cold["secs"],1e-9)*60,1)
+    result["cold_iot_calls"]=cold["iot_calls"]
+    result["cold_failed"]=cold["failed"]
+
+    cm = receiver_task.calendar_map
+    for room_name in room_names:
+        cm.scheduler.wake(room_name)
+    steady = tick()
+    result["steady_tick_secs"]=round(steady["secs"],3)
+    result["steady_rooms_per_min"]=round(steady["rooms"]/max(steady["secs"],1e-9)*60,1)
+    result["steady_iot_calls"]=steady["iot_calls"]
+
+    #burst of changes: every event of the room gets a new title, so the room
+    #status differs; published like gcalwatch after a notification
+    changed = room_names[:min(args.changes,len(room_names))]
+    #rooms processed by the ticks are recorded too
+    while not synced.empty():
+        synced.get()
+    before = log.snapshot()
+    published={}
+    for room_name in changed:
+        calendar_id = calendar_ids[room_name]
+        events = calendar.list_events(calendar_id,timeMin=time.strftime("%Y-%m-%dT%H:%M:%SZ",time.gmtime()))["items"]
+        for event in events:
+            event["summary"]="Changed "+event["summary"]
+            calendar.insert_event(calendar_id,event)
+        data,attributes = encode_room_events(room_name,events,int(time.time()*1000000))
+        published[room_name]=time.time()
+        attributes[ATTR_NOTIFIED]=str(int(published[room_name]*1000000))
+        pubsub.publish(topic,data,room_name,**attributes)
+    latencies=[]
+    failed=0
+    pending=set(changed)
+    deadline = time.time()+TICK_TIMEOUT
+    while pending and time.time()<deadline:
+        room_name,end,ok = synced.get(timeout=TICK_TIMEOUT)
+        if room_name in pending:
+            pending.discard(room_name)
+            if ok:
+                latencies.append((end-published[room_name])*1000)
+            else:
+                failed=failed+1
+    after = log.snapshot()
+    result["changes"]=len(changed)
+    result["change_failed"]=failed+len(pending)
+    result["change_p50_ms"]=round(fakes.percentile(latencies,50),1)
+    result["change_p95_ms"]=round(fakes.percentile(latencies,95),1)
+    result["change_max_ms"]=round(max(latencies),1) if latencies else float("nan")
+    result["change_iot_calls_per_room"]=round(fakes.CallLog.diff(after,before,"iot")/max(1,len(changed)),1)
+    result["iot_throttled"]=iot.throttled
+    print(json.dumps(result))
+    sys.stdout.flush()
+    #the updater thread never returns
+    os._exit(0)
+
+
+def run_size(rooms,argv):
+    output = subprocess.run([sys.executable,os.path.abspath(__file__),"--child",str(rooms)]+argv,
+                            cwd=ROOT,capture_output=True,text=True)
+    if output.returncode!=0:
+        sys.stderr.write(output.stderr)
+        raise RuntimeError("benchmark failed for rooms="+str(rooms))
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+COLUMNS=[("rooms","rooms"),("startup_secs","startup_s"),("cold_tick_secs","cold_s"),
+         ("cold_rooms_per_min","cold_rooms/min"),("cold_iot_calls","cold_iot_calls"),
+         ("steady_tick_secs","steady_s"),("steady_iot_calls","steady_iot_calls"),
+         ("change_p50_ms","chg_p50_ms"),("change_p95_ms","chg_p95_ms"),
+         ("change_iot_calls_per_room","chg_iot/room"),("iot_throttled","429s")]
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    if args.child>0:
+        run_child(args)
+        return
+    argv = [a for a in sys.argv[1:] if a!="--json"]
+    if not args.json:
+        print("  ".join(title for key,title in COLUMNS))
+    for rooms in [int(size) for size in args.sizes.split(",")]:
+        result = run_size(rooms,argv)
+        if args.json:
+            result["timestamp"]=int(time.time())
+            print(json.dumps(result))
+        else:
+            print("  ".join(str(result[key]).rjust(len(title)) for key,title in COLUMNS))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,394 @@
+#load test of the gcalwatch web service: replays bursts of Calendar push
+#notifications, mixed with meeting requests of the room devices, against
+#gcalwatch.app backed by the in-process fakes of benchmarks/fakes.py
+#(Calendar, GCS, Pub/Sub). Every scenario gets a fresh server:
+# - wsgi (default): the app is called in-process by a pool of --threads
+#   threads, like a single gunicorn worker with that many threads
+# - gunicorn: a local gunicorn --workers W --threads T, fakes installed in
+#   every worker (create_app), requests sent over HTTP
+#requests are open loop: a burst is sent as it would arrive from Google,
+#whatever the server keeps up with, and latency is measured from the
+#arrival time, so time spent waiting for a free server thread is included.
+#Reported per endpoint (/webhook, /meetings, /meeting/<id>): p50/p95/p99
+#latency, error rate (5xx or no response) and rejected rate (4xx)
+#run from the repository root:
+#  python benchmarks/bench_webhook.py [--calendars 10,100] [--bursts 20,100] [--threads 1,8,32]
+#  python benchmarks/bench_webhook.py --server gunicorn --workers 1,2 --threads 4,8 [--json]
+import argparse
+import http.client
+import itertools
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT=os.path.join(os.path.dirname(os.path.abspath(__file__)),"..")
+BENCH_DIR=os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,ROOT)
+sys.path.insert(0,BENCH_DIR)
+import fakes
+
+SETTINGS_ENV="BENCH_WEBHOOK_SETTINGS"  #create_app settings of gunicorn workers
+CLIENT_ID="bench"
+CLIENT_SECRET="bench-secret"
+REQUEST_TIMEOUT=120  #secs
+SERVER_START_TIMEOUT=60  #secs
+MAX_CLIENT_THREADS=512
+ENDPOINTS={"/webhook":"webhook","/meetings":"meetings","/meeting/<id>":"meeting_delete"}  #endpoint -> result key prefix
+WATCH_ID="gcalwatch_v5"  #gcalwatch.WATCH_ID, not imported by the load generator
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="gcalwatch webhook load test")
+    parser.add_argument("--server",choices=["wsgi","gunicorn"],default="wsgi")
+    parser.add_argument("--calendars",default="10,100",help="comma separated numbers of watched calendars")
+    parser.add_argument("--bursts",default="20,100",help="comma separated numbers of notifications per burst")
+    parser.add_argument("--threads",default="1,8,32",help="comma separated server threads per worker")
+    parser.add_argument("--workers",default="1",help="comma separated gunicorn workers, gunicorn server only")
+    parser.add_argument("--per-change",type=int,default=3,help="notifications sent by Google for one calendar change")
+    parser.add_argument("--spread-ms",type=float,default=1000,help="burst arrival window")
+    parser.add_argument("--meeting-share",type=float,default=0.2,
+                        help="meeting requests per notification, half /meetings and half /meeting/<id>")
+    parser.add_argument("--events",type=int,default=20,help="events per room calendar")
+    parser.add_argument("--coalesce-ms",type=float,default=500,help="webhook_coalesce_ms of the configuration")
+    parser.add_argument("--calendar-latency-ms",type=float,default=80)
+    parser.add_argument("--gcs-latency-ms",type=float,default=20)
+    parser.add_argument("--seed",type=int,default=0)
+    parser.add_argument("--json",action="store_true",help="print one JSON line per scenario")
+    parser.add_argument("--child",default="",help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def room_name(i):
+    return "room%04d" % i
+
+
+def free_room_name(i):
+    return "free%04d" % i
+
+
+def calendar_id(name):
+    return name+"@resource.calendar.example.com"
+
+
+######## server side
+
+backend = None  #fakes of the app created by create_app
+
+
+def create_app(settings=None):
+    #gcalwatch.app with the Google backends replaced by fakes; also the
+    #gunicorn entry point (bench_webhook:create_app()), settings then come
+    #from the environment
+    global backend
+    if settings is None:
+        settings = json.loads(os.environ[SETTINGS_ENV])
+    #the clients are installed below, nothing to prewarm
+    os.environ["GCALWATCH_PREWARM"]="0"
+    import gcalclient
+    import gcalwatch
+
+    log = fakes.CallLog()
+    calendar = fakes.FakeCalendar(log,settings["calendar_latency_ms"]/1000.0)
+    storage = fakes.FakeStorage(log,settings["gcs_latency_ms"]/1000.0)
+    pubsub = fakes.FakePubSub(log)
+    rooms=[]
+    #busy rooms, watched calendars the notifications are about; event ids
+    #are the same in every gunicorn worker, see make_room_events
+    for i in range(settings["calendars"]):
+        calendar.add_calendar(calendar_id(room_name(i)),fakes.make_room_events(settings["events"],seed=i))
+        rooms.append({"room_name":room_name(i),"gcal_calendar_id":calendar_id(room_name(i))})
+    #free rooms, each booked once by /meetings
+    for i in range(settings["free_rooms"]):
+        calendar.add_calendar(calendar_id(free_room_name(i)))
+        rooms.append({"room_name":free_room_name(i),"gcal_calendar_id":calendar_id(free_room_name(i))})
+    storage.put_json(gcalwatch.CONFIG_BUCKET_NAME,"config.json",{
+        "iot_client_id":CLIENT_ID,
+        "webhook_coalesce_ms":settings["coalesce_ms"],
+        "rooms":rooms
+    })
+
+    credentials = fakes.fake_credentials()
+    gcalwatch.get_credentials = lambda: credentials
+    gcalwatch.storage_client = storage.module().Client()
+    gcalwatch.calendar_client = calendar
+    gcalwatch.publisher = pubsub.module().PublisherClient()
+    gcalwatch.topic_path = "projects/"+credentials.project_id+"/topics/"+gcalwatch.TOPIC_NAME
+    gcalclient.get_calendar_service = lambda: calendar
+    #measured is the steady state, startup is measured by bench_coldstart
+    gcalwatch.config_cache.get()
+    backend = {"log":log,"calendar":calendar,"storage":storage,"pubsub":pubsub}
+    return gcalwatch.app
+
+
+######## load
+
+def make_requests(scenario):
+    #the burst: calendar changes arrive uniformly over spread_ms, Google sends
+    #per_change notifications for each with increasing message numbers
+    #within a few ms; meeting requests of the devices arrive in the same
+    #window. Returns requests sorted by arrival offset (secs)
+    rnd = random.Random(scenario["seed"])
+    spread = scenario["spread_ms"]/1000.0
+    message_numbers = {}
+    requests=[]
+    changes = int(math.ceil(scenario["burst"]/float(scenario["per_change"])))
+    sent=0
+    for change in range(changes):
+        name = room_name(rnd.randrange(scenario["calendars"]))
+        at = rnd.uniform(0,spread)
+        for j in range(min(scenario["per_change"],scenario["burst"]-sent)):
+            number = message_numbers.get(name,1)+1
+            message_numbers[name]=number
+            uri = ("https://www.googleapis.com/calendar/v3/calendars/"
+                   +urllib.parse.quote(calendar_id(name))+"/events?alt=json")
+            requests.append({"endpoint":"/webhook","method":"POST","path":"/webhook","body":None,
+                             "at":at+j*rnd.uniform(0.001,0.05),
+                             "headers":{"X-Goog-Channel-Id":WATCH_ID+"-"+name,
+                                        "X-Goog-Channel-Expiration":"Tue, 01 Dec 2099 00:00:00 GMT",
+                                        "X-Goog-Resource-Id":"resource-"+calendar_id(name),
+                                        "X-Goog-Resource-Uri":uri,
+                                        "X-Goog-Resource-State":"exists",
+                                        "X-Goog-Message-Number":str(number)}})
+            sent=sent+1
+    auth = {"Authorization":"Bearer "+CLIENT_SECRET}
+    #each booking on its own free room and each deletion of its own event,
+    #so every request is valid whichever gunicorn worker gets it
+    events = [(room_name(i),"ev"+str(i)+"x"+str(j)) for j in range(scenario["events"])
+              for i in range(scenario["calendars"])]
+    for i in range(scenario["bookings"]):
+        requests.append({"endpoint":"/meetings","method":"POST","path":"/meetings",
+                         "at":rnd.uniform(0,spread),"headers":auth,
+                         "body":{"client_id":CLIENT_ID,"room_name":free_room_name(i),"duration_mins":"30"}})
+    for i in range(scenario["deletions"]):
+        name,event_id = events[i]
+        requests.append({"endpoint":"/meeting/<id>","method":"DELETE","path":"/meeting/"+event_id,
+                         "at":rnd.uniform(0,spread),"headers":auth,
+                         "body":{"client_id":CLIENT_ID,"room_name":name}})
+    requests.sort(key=lambda r: r["at"])
+    return requests
+
+
+def send_wsgi(app,req):
+    from werkzeug.test import EnvironBuilder
+    #plain WSGI call, the Flask test client does not support every Werkzeug version
+    data = json.dumps(req["body"]) if req["body"] is not None else None
+    environ = EnvironBuilder(method=req["method"],path=req["path"],headers=req["headers"],data=data,
+                             content_type="application/json" if data is not None else None).get_environ()
+    statuses=[]
+    response = app(environ,lambda status,headers,exc_info=None: statuses.append(status))
+    try:
+        b"".join(response)
+    finally:
+        if hasattr(response,"close"):
+            response.close()
+    return int(statuses[0].split(" ",1)[0])
+
+
+def send_http(port,req):
+    #a new connection per request, like the push notifications
+    connection = http.client.HTTPConnection("127.0.0.1",port,timeout=REQUEST_TIMEOUT)
+    try:
+        headers = dict(req["headers"])
+        data = None
+        if req["body"] is not None:
+            data = json.dumps(req["body"])
+            headers["Content-Type"]="application/json"
+        connection.request(req["method"],req["path"],body=data,headers=headers)
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    finally:
+        connection.close()
+
+
+def run_load(requests,send,threads):
+    #open loop: each request is handed to the pool at its arrival time, its
+    #latency includes the wait for a free thread
+    results=[]
+    def timed_send(req,arrival):
+        try:
+            status = send(req)
+        except Exception as e:
+            status = 0
+        results.append((req["endpoint"],status,time.time()-arrival))
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for req in requests:
+            arrival = start+req["at"]
+            delay = arrival-time.time()
+            if delay>0:
+                time.sleep(delay)
+            executor.submit(timed_send,req,arrival)
+    return results,time.time()-start
+
+
+def summarize(scenario,results,duration):
+    result = {key:scenario[key] for key in ["server","workers","threads","calendars","burst"]}
+    result["requests"]=len(results)
+    result["duration_secs"]=round(duration,3)
+    result["requests_per_sec"]=round(len(results)/max(duration,1e-9),1)
+    for endpoint,key in ENDPOINTS.items():
+        latencies = [latency*1000 for e,status,latency in results if e==endpoint]
+        statuses = [status for e,status,latency in results if e==endpoint]
+        result[key+"_count"]=len(statuses)
+        for p in [50,95,99]:
+            result[key+"_p"+str(p)+"_ms"]=round(fakes.percentile(latencies,p),1)
+        #a request without response (status 0) is an error
+        errors = len([status for status in statuses if status==0 or status>=500])
+        rejected = len([status for status in statuses if 400<=status<500])
+        result[key+"_error_rate"]=round(errors/max(1,len(statuses)),4)
+        result[key+"_rejected_rate"]=round(rejected/max(1,len(statuses)),4)
+    return result
+
+
+######## scenarios
+
+def make_scenarios(args):
+    workers = [int(w) for w in args.workers.split(",")] if args.server=="gunicorn" else [1]
+    scenarios=[]
+    for calendars,burst,w,threads in itertools.product([int(c) for c in args.calendars.split(",")],
+                                                       [int(b) for b in args.bursts.split(",")],
+                                                       workers,
+                                                       [int(t) for t in args.threads.split(",")]):
+        meetings = int(round(burst*args.meeting_share))
+        deletions = meetings//2
+        scenarios.append({
+            "server":args.server,"workers":w,"threads":threads,"calendars":calendars,"burst":burst,
+            "per_change":args.per_change,"spread_ms":args.spread_ms,"seed":args.seed,
+            "bookings":meetings-deletions,"deletions":deletions,
+            #enough events for every deletion to target a different one
+            "events":max(args.events,int(math.ceil(deletions/float(calendars)))),
+            "coalesce_ms":args.coalesce_ms,
+            "calendar_latency_ms":args.calendar_latency_ms,"gcs_latency_ms":args.gcs_latency_ms})
+    return scenarios
+
+
+def settings_of(scenario):
+    return {"calendars":scenario["calendars"],"events":scenario["events"],"free_rooms":scenario["bookings"],
+            "coalesce_ms":scenario["coalesce_ms"],"calendar_latency_ms":scenario["calendar_latency_ms"],
+            "gcs_latency_ms":scenario["gcs_latency_ms"]}
+
+
+def run_child(scenario):
+    #runs in a fresh interpreter, module state of gcalwatch (config cache,
+    #coalescer, metrics) starts empty for every scenario
+    app = create_app(settings_of(scenario))
+    results,duration = run_load(make_requests(scenario),lambda req: send_wsgi(app,req),scenario["threads"])
+    result = summarize(scenario,results,duration)
+    #fetches and publishes of the last windows run after the responses
+    import gcalwatch
+    while not gcalwatch.webhook_coalescer.is_idle():
+        time.sleep(0.01)
+    result["publishes"]=fakes.CallLog.diff(backend["log"].snapshot(),{},"pubsub")
+    result["calendar_calls"]=fakes.CallLog.diff(backend["log"].snapshot(),{},"calendar")
+    print(json.dumps(result))
+    sys.stdout.flush()
+    #fake delivery threads are not waited for
+    os._exit(0)
+
+
+def run_wsgi(scenario):
+    env = dict(os.environ)
+    env["GCALWATCH_PREWARM"]="0"
+    #app logs are left on, they are part of the cost of a request
+    with tempfile.TemporaryFile() as stderr:
+        output = subprocess.run([sys.executable,os.path.abspath(__file__),"--child",json.dumps(scenario)],
+                                cwd=ROOT,env=env,stdout=subprocess.PIPE,stderr=stderr,text=True)
+        if output.returncode!=0:
+            stderr.seek(0)
+            sys.stderr.write(stderr.read().decode('utf-8','replace')[-5000:])
+            raise RuntimeError("benchmark failed for "+json.dumps(scenario))
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1",0))
+        return s.getsockname()[1]
+
+
+def wait_ready(server,port):
+    deadline = time.time()+SERVER_START_TIMEOUT
+    while time.time()<deadline:
+        if server.poll() is not None:
+            raise RuntimeError("gunicorn exited with code "+str(server.returncode))
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1",port,timeout=5)
+            connection.request("GET","/metrics?client_id="+CLIENT_ID,
+                               headers={"Authorization":"Bearer "+CLIENT_SECRET})
+            status = connection.getresponse().status
+            connection.close()
+            if status==200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError("gunicorn not ready on port "+str(port))
+
+
+def run_gunicorn(scenario):
+    #same command as docker/gcalwatch.Dockerfile, with the fake backends
+    port = free_port()
+    env = dict(os.environ)
+    env[SETTINGS_ENV]=json.dumps(settings_of(scenario))
+    env["GCALWATCH_PREWARM"]="0"
+    command = [sys.executable,"-m","gunicorn","--bind","127.0.0.1:"+str(port),
+               "--workers",str(scenario["workers"]),"--threads",str(scenario["threads"]),
+               "--timeout","0","--pythonpath",ROOT+","+BENCH_DIR,"bench_webhook:create_app()"]
+    with tempfile.TemporaryFile() as stderr:
+        server = subprocess.Popen(command,cwd=ROOT,env=env,stdout=subprocess.DEVNULL,stderr=stderr)
+        try:
+            wait_ready(server,port)
+            #every worker has loaded the app before the burst
+            time.sleep(1)
+            requests = make_requests(scenario)
+            results,duration = run_load(requests,lambda req: send_http(port,req),
+                                        min(MAX_CLIENT_THREADS,max(1,len(requests))))
+            return summarize(scenario,results,duration)
+        except Exception:
+            stderr.seek(0)
+            sys.stderr.write(stderr.read().decode('utf-8','replace')[-5000:])
+            raise
+        finally:
+            server.terminate()
+            server.wait()
+
+
+COLUMNS=[("workers","wrk"),("threads","thr"),("calendars","cals"),("burst","burst"),
+         ("requests_per_sec","req/s"),
+         ("webhook_p50_ms","wh_p50"),("webhook_p95_ms","wh_p95"),("webhook_p99_ms","wh_p99"),
+         ("webhook_error_rate","wh_err"),
+         ("meetings_p50_ms","mtg_p50"),("meetings_p95_ms","mtg_p95"),("meetings_p99_ms","mtg_p99"),
+         ("meetings_error_rate","mtg_err"),
+         ("meeting_delete_p50_ms","del_p50"),("meeting_delete_p95_ms","del_p95"),
+         ("meeting_delete_p99_ms","del_p99"),("meeting_delete_error_rate","del_err")]
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    if args.child!="":
+        run_child(json.loads(args.child))
+        return
+    if not args.json:
+        print("latency in ms from arrival, error rate = 5xx or no response")
+        print("  ".join(title.rjust(7) for key,title in COLUMNS))
+    for scenario in make_scenarios(args):
+        result = run_gunicorn(scenario) if args.server=="gunicorn" else run_wsgi(scenario)
+        if args.json:
+            result["timestamp"]=int(time.time())
+            print(json.dumps(result))
+        else:
+            print("  ".join(str(result[key]).rjust(7) for key,title in COLUMNS))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,589 @@
+#in-process stand-ins for Google Calendar, Arduino IoT Cloud, Pub/Sub and Cloud
+#Storage used by the offline benchmarks; they implement only what this
+#repository calls, with configurable latency, and count every call
+import io
+import itertools
+import json
+import queue
+import time
+from datetime import datetime,timezone,timedelta
+from threading import Lock,Thread
+from types import SimpleNamespace
+
+from google.api_core.exceptions import NotFound,PreconditionFailed
+from googleapiclient.errors import HttpError
+from iot_api_client.rest import ApiException
+
+from roomstatus import RoomStatus
+from timeline import parse_event_time
+import mylogger
+
+logger = mylogger.getlogger(__name__)
+
+PROPERTY_NAMES=list(RoomStatus.FIELD_NAMES)
+
+
+class CallLog:
+
+    #(api, op) -> number of calls
+
+    def __init__(self):
+        self.lock=Lock()
+        self.calls={}
+
+
+    def count(self,api,op):
+        with self.lock:
+            key=(api,op)
+            self.calls[key]=self.calls.get(key,0)+1
+
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.calls)
+
+
+    @staticmethod
+    def diff(after,before,api=None):
+        #calls made between two snapshots, optionally of a single api
+        return sum(n-before.get(key,0) for key,n in after.items() if api is None or key[0]==api)
+
+
+def parse_time(value):
+    return datetime.fromisoformat(value.replace("Z","+00:00"))
+
+
+######## Google Calendar
+
+class FakeRequest:
+
+    def __init__(self,service,op,function):
+        self.service=service
+        self.op=op
+        self.function=function
+
+
+    def execute(self):
+        self.service.log.count("calendar",self.op)
+        time.sleep(self.service.latency)
+        return self.function()
+
+
+class FakeEvents:
+
+    def __init__(self,service):
+        self.service=service
+
+
+    def list(self,calendarId,**params):
+        return FakeRequest(self.service,"events_list",lambda: self.service.list_events(calendarId,**params))
+
+
+    def insert(self,calendarId,body):
+        return FakeRequest(self.service,"events_insert",lambda: self.service.insert_event(calendarId,body))
+
+
+    def delete(self,calendarId,eventId):
+        return FakeRequest(self.service,"events_delete",lambda: self.service.delete_event(calendarId,eventId))
+
+
+    def watch(self,calendarId,body):
+        return FakeRequest(self.service,"events_watch",lambda: self.service.watch(calendarId,body))
+
+
+class FakeChannels:
+
+    def __init__(self,service):
+        self.service=service
+
+
+    def stop(self,body):
+        return FakeRequest(self.service,"channels_stop",lambda: {})
+
+
+class FakeBatch:
+
+    #one round trip for all the requests, like the batch endpoint
+
+    def __init__(self,service,callback):
+        self.service=service
+        self.callback=callback
+        self.requests=[]
+
+
+    def add(self,request,request_id=None):
+        self.requests.append((request_id,request))
+
+
+    def execute(self):
+        self.service.log.count("calendar","batch")
+        time.sleep(self.service.latency)
+        for request_id,request in self.requests:
+            self.service.log.count("calendar",request.op)
+            try:
+                response,exception = request.function(),None
+            except Exception as e:
+                response,exception = None,e
+            self.callback(request_id,response,exception)
+
+
+class FakeCalendar:
+
+    #calendar_id -> events by id; every change gets a sequence number that
+    #is used as sync token
+
+    def __init__(self,log,latency=0.02):
+        self.log=log
+        self.latency=latency
+        self.lock=Lock()
+        self.calendars={}
+        self.seq=0
+        self.ids=itertools.count()
+
+
+    def add_calendar(self,calendar_id,events=()):
+        with self.lock:
+            self.calendars[calendar_id]={"events":{},"changes":{}}
+        for event in events:
+            self.insert_event(calendar_id,event)
+
+
+    def events(self):
+        return FakeEvents(self)
+
+
+    def channels(self):
+        return FakeChannels(self)
+
+
+    def new_batch_http_request(self,callback=None):
+        return FakeBatch(self,callback)
+
+
+    def get_calendar(self,calendar_id):
+        calendar = self.calendars.get(calendar_id)
+        if calendar is None:
+            raise HttpError(SimpleNamespace(status=404,reason="Not Found"),b"calendar not found")
+        return calendar
+
+
+    def list_events(self,calendar_id,timeMin=None,timeMax=None,maxResults=250,pageToken=None,
+                    syncToken=None,orderBy=None,**params):
+        with self.lock:
+            calendar = self.get_calendar(calendar_id)
+            if syncToken is not None:
+                since = int(syncToken)
+                items = [calendar["events"].get(event_id,{"id":event_id,"status":"cancelled"})
+                         for event_id,seq in calendar["changes"].items() if seq>since]
+            else:
+                start = parse_time(timeMin) if timeMin else None
+                end = parse_time(timeMax) if timeMax else None
+                items=[]
+                for event in calendar["events"].values():
+                    if start is not None and parse_event_time(event["end"]["dateTime"])<=start:
+                        continue
+                    if end is not None and parse_event_time(event["start"]["dateTime"])>=end:
+                        continue
+                    items.append(event)
+                items.sort(key=lambda event: parse_event_time(event["start"]["dateTime"]))
+            offset = int(pageToken or 0)
+            result = {"items":[dict(event) for event in items[offset:offset+maxResults]]}
+            if offset+maxResults<len(items):
+                result["nextPageToken"]=str(offset+maxResults)
+            else:
+                result["nextSyncToken"]=str(self.seq)
+            return result
+
+
+    def insert_event(self,calendar_id,body):
+        with self.lock:
+            calendar = self.get_calendar(calendar_id)
+            event = dict(body)
+            event.setdefault("id","fake"+str(next(self.ids)))
+            event.setdefault("status","confirmed")
+            self.seq=self.seq+1
+            calendar["events"][event["id"]]=event
+            calendar["changes"][event["id"]]=self.seq
+            return dict(event)
+
+
+    def delete_event(self,calendar_id,event_id):
+        with self.lock:
+            calendar = self.get_calendar(calendar_id)
+            if calendar["events"].pop(event_id,None) is None:
+                raise HttpError(SimpleNamespace(status=404,reason="Not Found"),b"event not found")
+            self.seq=self.seq+1
+            calendar["changes"][event_id]=self.seq
+            return ""
+
+
+    def watch(self,calendar_id,body):
+        expiration = int((time.time()+7*24*3600)*1000)
+        return {"kind":"api#channel","id":body["id"],"resourceId":"resource-"+calendar_id,
+                "resourceUri":"https://www.googleapis.com/calendar/v3/calendars/"+calendar_id+"/events",
+                "expiration":str(expiration)}
+
+
+def make_room_events(count,start=None,seed=0):
+    #back to back meetings starting 30 mins ago, 30 to 90 mins long
+    start = start or datetime.now(timezone.utc).replace(second=0,microsecond=0)-timedelta(minutes=30)
+    events=[]
+    for i in range(count):
+        end = start+timedelta(minutes=30*(1+(seed+i)%3))
+        events.append({
+            "id":"ev"+str(seed)+"x"+str(i),
+            "summary":"Meeting "+str(i),
+            "start":{"dateTime":start.strftime("%Y-%m-%dT%H:%M:%S+00:00")},
+            "end":{"dateTime":end.strftime("%Y-%m-%dT%H:%M:%S+00:00")},
+            "attendees":[{"email":"organizer"+str(i)+"@example.com","organizer":True,"responseStatus":"accepted"},
+                         {"email":"room@example.com","self":True,"responseStatus":"accepted"}]
+        })
+        start = end+timedelta(minutes=15)
+    return events
+
+
+######## Arduino IoT Cloud
+
+class FakeHTTPResponse:
+
+    def __init__(self,status=200,headers=None):
+        self.status=status
+        self.headers=headers or {}
+        self.data=b""
+
+
+    def getheaders(self):
+        return self.headers
+
+
+class FakeApiResponse:
+
+    def __init__(self,body,status=200,headers=None):
+        self.body=body
+        self.response=FakeHTTPResponse(status,headers)
+
+
+class FakeIotCloud:
+
+    #things named after rooms, each with the properties read by IotClient;
+    #written values become visible after propagation secs; requests over
+    #rps (token bucket of size burst) are answered with 429 and Retry-After
+
+    def __init__(self,log,latency=0.005,rps=1000.0,burst=100,propagation=0.0):
+        self.log=log
+        self.latency=latency
+        self.rps=rps
+        self.burst=burst
+        self.propagation=propagation
+        self.lock=Lock()
+        self.things={}  #thing id -> name
+        self.properties={}  #thing id -> property name -> {"id","value","visible_at","pending"}
+        self.tokens=float(burst)
+        self.last_refill=time.monotonic()
+        self.throttled=0
+        self.writes=[]  #(time, room name, property name, value)
+
+
+    def add_thing(self,room_name):
+        thing_id = "thing-"+room_name
+        with self.lock:
+            self.things[thing_id]=room_name
+            self.properties[thing_id]={name:{"id":thing_id+"-"+name,"value":"","visible_at":0,"pending":None}
+                                       for name in PROPERTY_NAMES}
+        return thing_id
+
+
+    def request(self,op):
+        self.log.count("iot",op)
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst,self.tokens+(now-self.last_refill)*self.rps)
+            self.last_refill = now
+            if self.tokens<1:
+                self.throttled=self.throttled+1
+                retry_after = str(max(1,int((1-self.tokens)/self.rps+0.999)))
+                raise ApiException(status=429,reason="Too Many Requests",
+                                   api_response=FakeApiResponse(None,429,{"Retry-After":retry_after}))
+            self.tokens=self.tokens-1
+        time.sleep(self.latency)
+
+
+    def value(self,prop):
+        #pending write replaces the value once it has propagated
+        if prop["pending"] is not None and time.time()>=prop["visible_at"]:
+            prop["value"]=prop["pending"]
+            prop["pending"]=None
+        return prop["value"]
+
+
+    def get_value(self,room_name,property_name):
+        with self.lock:
+            return self.value(self.properties["thing-"+room_name][property_name])
+
+
+    def things_v2_list(self):
+        self.request("things_v2_list")
+        with self.lock:
+            return FakeApiResponse([{"id":thing_id,"name":name} for thing_id,name in self.things.items()])
+
+
+    def properties_v2_list(self,path_params):
+        self.request("properties_v2_list")
+        with self.lock:
+            props = self.properties.get(path_params["id"])
+            if props is None:
+                raise ApiException(status=404,reason="Not Found")
+            return FakeApiResponse([{"id":p["id"],"name":name,"last_value":self.value(p)} for name,p in props.items()])
+
+
+    def properties_v2_publish(self,path_params,body):
+        self.request("properties_v2_publish")
+        with self.lock:
+            props = self.properties.get(path_params["id"])
+            if props is None:
+                raise ApiException(status=404,reason="Not Found")
+            for name,prop in props.items():
+                if prop["id"]==path_params["pid"]:
+                    self.value(prop)
+                    prop["pending"]=body["value"]
+                    prop["visible_at"]=time.time()+self.propagation
+                    self.writes.append((time.time(),self.things[path_params["id"]],name,body["value"]))
+                    return FakeApiResponse({})
+            raise ApiException(status=404,reason="Not Found")
+
+
+    def things_api(self,client=None):
+        return SimpleNamespace(things_v2_list=self.things_v2_list)
+
+
+    def properties_api(self,client=None):
+        return SimpleNamespace(properties_v2_list=self.properties_v2_list,
+                               properties_v2_publish=self.properties_v2_publish)
+
+
+class FakeOAuth2Session:
+
+    #replaces requests_oauthlib.OAuth2Session in tokenmanager
+
+    def __init__(self,client=None):
+        self.client=client
+
+
+    def fetch_token(self,**params):
+        return {"access_token":"fake-token","token_type":"Bearer","expires_in":3600}
+
+
+######## Pub/Sub
+
+class FakeMessage:
+
+    def __init__(self,data,attributes,message_id):
+        self.data=data
+        self.attributes=attributes
+        self.message_id=message_id
+        self.publish_time=datetime.now(timezone.utc)
+
+
+    def ack(self):
+        return
+
+
+class FakeFuture:
+
+    def __init__(self,result):
+        self.value=result
+
+
+    def result(self,timeout=None):
+        return self.value
+
+
+    def add_done_callback(self,callback):
+        callback(self)
+
+
+class FakePubSub:
+
+    #topic path -> subscriber callbacks; messages are delivered in publish
+    #order by a single delivery thread
+
+    def __init__(self,log,latency=0.0):
+        self.log=log
+        self.latency=latency
+        self.lock=Lock()
+        self.subscribers={}
+        self.ids=itertools.count()
+        self.deliveries=queue.Queue()
+        thread = Thread(target=self.deliver,daemon=True)
+        thread.name = "fake_pubsub"
+        thread.start()
+
+
+    def deliver(self):
+        while True:
+            callbacks,message = self.deliveries.get()
+            time.sleep(self.latency)
+            for callback in callbacks:
+                try:
+                    callback(message)
+                except Exception as e:
+                    logger.error("Subscriber callback failed: {}".format(e))
+
+
+    def publish(self,topic,data,ordering_key="",**attributes):
+        self.log.count("pubsub","publish")
+        message_id = str(next(self.ids))
+        with self.lock:
+            callbacks = list(self.subscribers.get(topic,[]))
+        self.deliveries.put((callbacks,FakeMessage(data,attributes,message_id)))
+        return FakeFuture(message_id)
+
+
+    def subscribe(self,subscription,callback):
+        #subscription "projects/p/subscriptions/<topic>-sub" receives "projects/p/topics/<topic>"
+        project,name = subscription.split("/subscriptions/")
+        topic = project+"/topics/"+name[:-len("-sub")]
+        with self.lock:
+            self.subscribers.setdefault(topic,[]).append(callback)
+        return FakeFuture(None)
+
+
+    def subscriber_count(self):
+        with self.lock:
+            return sum(len(callbacks) for callbacks in self.subscribers.values())
+
+
+    def module(self):
+        #stand-in for google.cloud.pubsub_v1
+        pubsub = self
+        class PublisherClient:
+            def __init__(self,*args,**kwargs):
+                return
+            def publish(self,topic,data,ordering_key="",**attributes):
+                return pubsub.publish(topic,data,ordering_key,**attributes)
+            def resume_publish(self,topic,ordering_key):
+                return
+        class SubscriberClient:
+            def __init__(self,*args,**kwargs):
+                return
+            def subscribe(self,subscription,callback):
+                return pubsub.subscribe(subscription,callback)
+        types = SimpleNamespace(BatchSettings=lambda **kwargs: kwargs,PublisherOptions=lambda **kwargs: kwargs)
+        return SimpleNamespace(PublisherClient=PublisherClient,SubscriberClient=SubscriberClient,types=types)
+
+
+######## Cloud Storage
+
+class FakeBlob:
+
+    def __init__(self,storage,bucket_name,name,generation=None):
+        self.storage=storage
+        self.bucket_name=bucket_name
+        self.name=name
+        self.generation=generation
+
+
+    def key(self):
+        return (self.bucket_name,self.name)
+
+
+    def download_as_bytes(self,if_generation_match=None):
+        self.storage.log.count("gcs","download")
+        time.sleep(self.storage.latency)
+        with self.storage.lock:
+            entry = self.storage.blobs.get(self.key())
+            if entry is None:
+                raise NotFound(self.name)
+            if if_generation_match is not None and entry[1]!=if_generation_match:
+                raise PreconditionFailed(self.name)
+            return entry[0]
+
+
+    def upload_from_string(self,data,content_type=None,if_generation_match=None):
+        self.storage.log.count("gcs","upload")
+        time.sleep(self.storage.latency)
+        if isinstance(data,str):
+            data = data.encode('utf-8')
+        with self.storage.lock:
+            entry = self.storage.blobs.get(self.key())
+            current = entry[1] if entry is not None else 0
+            if if_generation_match is not None and current!=if_generation_match:
+                raise PreconditionFailed(self.name)
+            self.generation = next(self.storage.generations)
+            self.storage.blobs[self.key()]=(data,self.generation)
+
+
+    def open(self,mode="r"):
+        if mode.startswith("r"):
+            data = self.download_as_bytes()
+            return io.BytesIO(data) if "b" in mode else io.StringIO(data.decode('utf-8'))
+        blob = self
+        class Writer(io.StringIO):
+            def close(self):
+                blob.upload_from_string(self.getvalue())
+                io.StringIO.close(self)
+        return Writer()
+
+
+class FakeBucket:
+
+    def __init__(self,storage,name):
+        self.storage=storage
+        self.name=name
+
+
+    def blob(self,name):
+        return FakeBlob(self.storage,self.name,name)
+
+
+    def get_blob(self,name):
+        self.storage.log.count("gcs","metadata")
+        with self.storage.lock:
+            entry = self.storage.blobs.get((self.name,name))
+        if entry is None:
+            return None
+        return FakeBlob(self.storage,self.name,name,entry[1])
+
+
+class FakeStorage:
+
+    def __init__(self,log,latency=0.01):
+        self.log=log
+        self.latency=latency
+        self.lock=Lock()
+        self.blobs={}  #(bucket, name) -> (data, generation)
+        self.generations=itertools.count(1)
+
+
+    def put(self,bucket_name,name,data):
+        FakeBlob(self,bucket_name,name).upload_from_string(data)
+
+
+    def put_json(self,bucket_name,name,content):
+        self.put(bucket_name,name,json.dumps(content))
+
+
+    def bucket(self,name):
+        return FakeBucket(self,name)
+
+
+    def module(self):
+        #stand-in for google.cloud.storage
+        storage = self
+        class Client:
+            def __init__(self,*args,**kwargs):
+                return
+            def bucket(self,name):
+                return storage.bucket(name)
+        return SimpleNamespace(Client=Client)
+
+
+def fake_credentials(project_id="bench-project"):
+    return SimpleNamespace(project_id=project_id)
+
+
+def percentile(values,p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values)-1,int(round(p/100.0*(len(values)-1))))]
@@ -1,18 +1,44 @@
 import json
+import time
 from threading import Lock
+from timeline import EventTimeline
+from wakeupqueue import WakeupQueue
+import metrics
+
+LOCK_WAIT = metrics.histogram("roomcal_calendarmap_lock_wait_seconds","Wait to acquire the CalendarMap lock",
+                              buckets=(0.00001,0.0001,0.001,0.01,0.1,1))
+WAKEUP_QUEUE_DEPTH = metrics.gauge("roomcal_wakeup_queue_depth","Wakeups pending in the updater queue")
 
 class CalendarMap:
     
-    calendars = {}    
+    #room timelines are immutable snapshots: readers just take the current
+    #one without locking, writers swap it under a lock held only for the swap
+    timelines = {}
+    versions = {}
+    #last room status known to be in iotcloud, checkpointed for warm starts
+    statuses = {}
+    #earliest webhook receipt time not yet propagated to iotcloud, per room
+    notified = {}
+    #span context of the last received events not yet processed, per room
+    traces = {}
     ids = {}           
     lock = Lock()
-    wakeup_events=[]
+    lock_stats = {"acquisitions":0,"wait_total":0.0,"wait_max":0.0}
+    wakeup_events=WakeupQueue()
+    #optional TransitionScheduler, re-planned whenever the events of a room change
+    scheduler = None
 
     REASON_REGULAR="WAKEUP_REGULAR"
     REASON_CALENDARCHANGE="WAKEUP_CALENDARCHANGE"
 
     def acquireLock(self):
+        start = time.monotonic()
         self.lock.acquire()
+        waited = time.monotonic()-start
+        self.lock_stats["acquisitions"]+=1
+        self.lock_stats["wait_total"]+=waited
+        self.lock_stats["wait_max"]=max(self.lock_stats["wait_max"],waited)
+        LOCK_WAIT.observe(waited)
         return
     
     def releaseLock(self):
@@ -21,26 +47,95 @@ class CalendarMap:
 
 
     def pushWakeup(self,reason,calendar_name):
-        self.wakeup_events.append({ "reason": reason, "calendar_name":calendar_name})
+        #coalesced if the same wakeup is already pending
+        return self.wakeup_events.push(reason,calendar_name)
 
-    def popWakeup(self):
-        if self.wakeup_events:
-            return self.wakeup_events.pop() 
-        else:
-            return {}
+    def popWakeup(self,block=False,timeout=None):
+        #oldest pending wakeup, {} if there is none
+        return self.wakeup_events.pop(block,timeout)
     
     
    
     
-    def setCalendar(self,name,value):
-        self.calendars[name]=value
-        return 
+    def setCalendar(self,name,value,version=None):
+        #events are compiled once here, status lookups then need no parsing
+        return self.setTimeline(name,EventTimeline.from_events(value),version)
+
+
+    def setTimeline(self,name,timeline,version=None):
+        #version is the fetch time of the events, a snapshot older than the
+        #one already applied is dropped and False is returned
+        self.acquireLock()
+        try:
+            if version is not None:
+                last = self.versions.get(name)
+                if last is not None and version<last:
+                    return False
+                self.versions[name]=version
+            self.timelines[name]=timeline
+            #planned under the lock, so concurrent writers of a room plan in
+            #the order they swap and the last plan is for the current timeline
+            if self.scheduler is not None:
+                self.scheduler.plan(name,timeline)
+        finally:
+            self.releaseLock()
+        return True
+
+
+    def replan(self,name):
+        #plans the current timeline again (e.g. after the room is processed),
+        #under the lock so it cannot overwrite the plan of a newer timeline
+        if self.scheduler is None:
+            return
+        self.acquireLock()
+        try:
+            self.scheduler.plan(name,self.getTimeline(name))
+        finally:
+            self.releaseLock()
 
 
     def getCalendar(self,name):
-        if name in self.calendars:
-            return self.calendars[name]
-        return ""
+        #compact event rows, see timeline.compact_event
+        return self.getTimeline(name).rows
+
+    def getTimeline(self,name):
+        #snapshot, never modified after it is set
+        timeline = self.timelines.get(name)
+        if timeline is None:
+            return EventTimeline()
+        return timeline
+
+    def setLastStatus(self,name,status):
+        self.statuses[name]=status
+
+    def getLastStatus(self,name):
+        return self.statuses.get(name)
+
+    def setNotifiedAt(self,name,notified_at):
+        #keeps the oldest pending notification, it is the one that waited the most
+        self.acquireLock()
+        try:
+            if name not in self.notified or notified_at<self.notified[name]:
+                self.notified[name]=notified_at
+        finally:
+            self.releaseLock()
+
+    def setTrace(self,name,context):
+        self.traces[name]=context
+
+    def popTrace(self,name):
+        #None when the room is processed because of a regular tick
+        return self.traces.pop(name,None)
+
+    def popNotifiedAt(self,name):
+        self.acquireLock()
+        try:
+            return self.notified.pop(name,None)
+        finally:
+            self.releaseLock()
+
+    def getLockStats(self):
+        return dict(self.lock_stats)
 
     def setCalendarId(self,name,value):
         self.ids[name]=value
@@ -69,4 +164,4 @@ class CalendarMap:
         return self.__dict__.__str__()
 
 
-     
\ No newline at end of file
+WAKEUP_QUEUE_DEPTH.set_function(CalendarMap.wakeup_events.depth)
@@ -0,0 +1,201 @@
+from threading import Lock
+import json
+import random
+import time
+import uuid
+import mylogger
+import metrics
+
+logger = mylogger.getlogger(__name__)
+
+CHANNELS_BLOB="channels.json"
+RENEW_AHEAD=6*3600  #channels are renewed this many secs before they expire
+RENEW_JITTER=3600   #random extra advance, spreads renewals of channels created together
+SAVE_ATTEMPTS=3
+
+STATUS_OK="ok"
+STATUS_EXPIRING="expiring"
+STATUS_EXPIRED="expired"
+STATUS_MISSING="missing"
+
+
+class ChannelManager:
+
+    #all watch channels in a single state object stored in GCS:
+    #room_name -> channel_id, resource_id, calendar_id, expiration, renew_at
+
+    def __init__(self,get_storage_client,bucket_name,watch_id,blob_name=CHANNELS_BLOB):
+        self.get_storage_client=get_storage_client
+        self.bucket_name=bucket_name
+        self.watch_id=watch_id
+        self.blob_name=blob_name
+        self.lock=Lock()
+        self.channels={}
+        self.generation=None
+        self.loaded=False
+        self.dirty=set()
+
+
+    def is_current_channel_id(self,channel_id):
+        #channel ids are watch_id plus a unique suffix, older watch versions are ignored
+        return channel_id==self.watch_id or channel_id.startswith(self.watch_id+"-")
+
+
+    def get_blob(self):
+        return self.get_storage_client().bucket(self.bucket_name).blob(self.blob_name)
+
+
+    def fetch(self):
+        with metrics.timed("gcs","channels_fetch"):
+            blob = self.get_storage_client().bucket(self.bucket_name).get_blob(self.blob_name)
+            if blob is None:
+                return {},0
+            content = json.loads(blob.download_as_bytes(if_generation_match=blob.generation))
+        return content.get("rooms",{}),blob.generation
+
+
+    def refresh(self):
+        #re-reads the state, keeping local changes not saved yet
+        with self.lock:
+            channels,generation = self.fetch()
+            for room_name in self.dirty:
+                channels[room_name]=self.channels[room_name]
+            self.channels=channels
+            self.generation=generation
+            self.loaded=True
+
+
+    def ensure_loaded(self):
+        #the state is read once, requests that replace channels refresh it
+        #first so the channel they supersede is the current one
+        if not self.loaded:
+            self.refresh()
+
+
+    def get(self,room_name):
+        self.ensure_loaded()
+        with self.lock:
+            channel = self.channels.get(room_name)
+            return dict(channel) if channel is not None else None
+
+
+    def save(self):
+        #conditional write, on a concurrent update from another instance the
+        #state is merged with the remote one and written again
+        from google.api_core.exceptions import PreconditionFailed
+        with self.lock:
+            for attempt in range(SAVE_ATTEMPTS):
+                content = json.dumps({"rooms":self.channels})
+                blob = self.get_blob()
+                try:
+                    with metrics.timed("gcs","channels_save"):
+                        blob.upload_from_string(content,content_type="application/json",
+                                                if_generation_match=self.generation or 0)
+                    self.generation=blob.generation
+                    self.dirty.clear()
+                    return True
+                except PreconditionFailed:
+                    logger.info("Channel state changed concurrently, merging")
+                    metrics.API_RETRIES.labels(api="gcs",reason="precondition_failed").inc()
+                    channels,generation = self.fetch()
+                    for room_name in self.dirty:
+                        channels[room_name]=self.channels[room_name]
+                    self.channels=channels
+                    self.generation=generation
+            logger.error("Unable to save channel state")
+            #another instance keeps changing the state, it is read again
+            #before its next use
+            self.loaded=False
+            metrics.API_FAILURES.labels(api="gcs",op="channels_save").inc()
+            return False
+
+
+    def stop_channel(self,calendar_client,channel_id,resource_id):
+        try:
+            logger.info("Stopping to watch "+channel_id+":"+resource_id)
+            with metrics.timed("calendar","channels_stop"):
+                calendar_client.channels().stop(body={
+                    'id': channel_id,
+                    'resourceId': resource_id
+                }).execute()
+        except Exception as e:
+            #already expired or stopped
+            logger.warning("Not able to stop channel "+channel_id+": {}".format(e))
+
+
+    def watch(self,calendar_client,room_name,calendar_id,url,save=True):
+        #creates a new channel for the room, then stops the one it supersedes
+        previous = self.get(room_name)
+        channel_id = self.watch_id+"-"+uuid.uuid4().hex
+        logger.info("Starting to watch "+calendar_id+" channel="+channel_id)
+        with metrics.timed("calendar","events_watch"):
+            response = calendar_client.events().watch(calendarId=calendar_id, body={
+                'id': channel_id,
+                'type': 'web_hook',
+                'address': url
+            }).execute()
+        logger.info(response)
+        expiration = int(response.get("expiration",0))/1000.0
+        channel = {
+            "channel_id":channel_id,
+            "resource_id":response.get("resourceId",""),
+            "calendar_id":calendar_id,
+            "expiration":expiration,
+            "renew_at":expiration-RENEW_AHEAD-random.uniform(0,RENEW_JITTER),
+            "created_at":time.time()
+        }
+        with self.lock:
+            self.channels[room_name]=channel
+            self.dirty.add(room_name)
+        if save:
+            self.save()
+        if previous is not None:
+            self.stop_channel(calendar_client,previous["channel_id"],previous["resource_id"])
+        return response
+
+
+    def get_status(self,channel,calendar_id,now):
+        if channel is None or channel.get("calendar_id")!=calendar_id:
+            return STATUS_MISSING
+        if channel["expiration"]<=now:
+            return STATUS_EXPIRED
+        if channel["renew_at"]<=now:
+            return STATUS_EXPIRING
+        return STATUS_OK
+
+
+    def health(self,calendars):
+        #calendars: room_name -> calendar_id of the configured rooms
+        self.refresh()
+        now = time.time()
+        result={}
+        with self.lock:
+            for room_name,calendar_id in calendars.items():
+                channel = self.channels.get(room_name)
+                status = self.get_status(channel,calendar_id,now)
+                entry = {"status":status}
+                if channel is not None:
+                    entry["channel_id"]=channel["channel_id"]
+                    entry["expires_in"]=int(channel["expiration"]-now)
+                result[room_name]=entry
+        return result
+
+
+    def renew_due(self,calendar_client,calendars,url):
+        #renews channels that are missing, expired or close to expiry
+        self.refresh()
+        now = time.time()
+        with self.lock:
+            due = [room_name for room_name,calendar_id in calendars.items()
+                   if self.get_status(self.channels.get(room_name),calendar_id,now)!=STATUS_OK]
+        result={}
+        for room_name in due:
+            try:
+                self.watch(calendar_client,room_name,calendars[room_name],url,save=False)
+                result[room_name]="renewed"
+            except Exception as e:
+                logger.error("Unable to renew channel for "+room_name+": {}".format(e))
+                result[room_name]="error: {}".format(e)
+        if due:
+            self.save()
+        return result
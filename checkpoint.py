@@ -0,0 +1,169 @@
+from threading import Lock
+from roomstatus import RoomStatus
+from timeline import EventTimeline
+import json
+import os
+import time
+import zlib
+import mylogger
+import metrics
+
+logger = mylogger.getlogger(__name__)
+
+#file layout: header line "RCCP/<format version>\n" followed by zlib compressed JSON
+#{"saved_at":secs,
+# "rooms":{room_name:{"cal":calendar_id,"ver":events version,"ev":[compact event rows],"st":last written status}},
+# "things":{"refreshed_at":secs,"entries":{room_name:thing metadata}}}
+MAGIC=b"RCCP"
+FORMAT_VERSION=1
+CHECKPOINT_BLOB="updater_checkpoint.bin"
+CHECKPOINT_INTERVAL=300  #secs between checkpoints
+MAX_AGE=24*3600  #older checkpoints are ignored, a cold start is done instead
+
+
+def status_to_dict(status):
+    #thing metadata is kept by the thing index, not in the status
+    values = status.as_dict()
+    del values["metadata"]
+    return values
+
+
+def status_from_dict(values):
+    return RoomStatus.from_dict(values)
+
+
+def encode(state):
+    header = MAGIC+b"/"+str(FORMAT_VERSION).encode('ascii')+b"\n"
+    return header+zlib.compress(json.dumps(state,separators=(",",":")).encode('utf-8'))
+
+
+def decode(data):
+    header,sep,body = data.partition(b"\n")
+    if sep==b"" or not header.startswith(MAGIC+b"/"):
+        raise ValueError("Not a checkpoint")
+    version = header[len(MAGIC)+1:].decode('ascii')
+    if version!=str(FORMAT_VERSION):
+        raise ValueError("Unsupported checkpoint format "+version)
+    return json.loads(zlib.decompress(body).decode('utf-8'))
+
+
+class Checkpoint:
+
+    #periodic snapshot of the updater state (room timelines, thing index and
+    #last written room status) so that a restarted updater can serve right
+    #away and download calendars in background; optionally mirrored to a
+    #bucket for pods that do not keep their local disk
+
+    def __init__(self,path,storage_client=None,bucket_name="",blob_name=CHECKPOINT_BLOB):
+        self.path=path
+        self.storage_client=storage_client
+        self.bucket_name=bucket_name
+        self.blob_name=blob_name
+        self.save_lock=Lock()
+        self.saved_at=0
+
+
+    def is_mirrored(self):
+        return self.storage_client is not None and self.bucket_name!=""
+
+
+    def capture(self,cm,thing_index,calendars):
+        #timelines are immutable snapshots, no lock needed to read them
+        rooms={}
+        for room_name,calendar_id in calendars.items():
+            entry = {"cal":calendar_id,
+                     "ver":cm.versions.get(room_name),
+                     "ev":[list(row) for row in cm.getTimeline(room_name).rows]}
+            status = cm.getLastStatus(room_name)
+            if status is not None:
+                entry["st"]=status_to_dict(status)
+            rooms[room_name]=entry
+        refreshed_at,entries = thing_index.snapshot()
+        return {"saved_at":time.time(),
+                "rooms":rooms,
+                "things":{"refreshed_at":refreshed_at,"entries":entries}}
+
+
+    def save(self,cm,thing_index,calendars):
+        #returns False if another save is still running
+        if not self.save_lock.acquire(blocking=False):
+            return False
+        try:
+            start = time.time()
+            data = encode(self.capture(cm,thing_index,calendars))
+            tmppath = self.path+".tmp"
+            with open(tmppath,"wb") as f:
+                f.write(data)
+            os.replace(tmppath,self.path)
+            if self.is_mirrored():
+                blob = self.storage_client.bucket(self.bucket_name).blob(self.blob_name)
+                with metrics.timed("gcs","checkpoint_save"):
+                    blob.upload_from_string(data,content_type="application/octet-stream")
+            self.saved_at=time.time()
+            logger.info("Checkpoint saved rooms="+str(len(calendars))+" bytes="+str(len(data))
+                        +" in secs="+str(round(self.saved_at-start,2)))
+            return True
+        except Exception as e:
+            logger.error("Unable to save checkpoint: {}".format(e))
+            return False
+        finally:
+            self.save_lock.release()
+
+
+    def is_due(self,interval=CHECKPOINT_INTERVAL):
+        return time.time()>=self.saved_at+interval
+
+
+    def read(self):
+        #local file first, then the bucket mirror
+        try:
+            with open(self.path,"rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            pass
+        if self.is_mirrored():
+            with metrics.timed("gcs","checkpoint_load"):
+                blob = self.storage_client.bucket(self.bucket_name).get_blob(self.blob_name)
+                if blob is not None:
+                    return blob.download_as_bytes()
+        return None
+
+
+    def load(self):
+        #returns the checkpointed state, None if missing, unreadable or too old
+        try:
+            data = self.read()
+            if data is None:
+                logger.info("No checkpoint found")
+                return None
+            state = decode(data)
+        except Exception as e:
+            logger.error("Unable to load checkpoint: {}".format(e))
+            return None
+        age = time.time()-state.get("saved_at",0)
+        if age>MAX_AGE:
+            logger.info("Ignoring checkpoint saved secs="+str(int(age))+" ago")
+            return None
+        return state
+
+
+    def restore(self,cm,thing_index,calendars):
+        #loads the checkpoint into cm and thing_index, returns the restored rooms;
+        #rooms whose calendar changed in configuration are not restored
+        state = self.load()
+        if state is None:
+            return []
+        things = state.get("things",{})
+        thing_index.restore(things.get("refreshed_at",0),things.get("entries",{}))
+        restored=[]
+        for room_name,entry in state.get("rooms",{}).items():
+            if calendars.get(room_name)!=entry.get("cal"):
+                continue
+            cm.setTimeline(room_name,EventTimeline([tuple(row) for row in entry.get("ev",[])]),entry.get("ver"))
+            if "st" in entry:
+                cm.setLastStatus(room_name,status_from_dict(entry["st"]))
+            restored.append(room_name)
+        self.saved_at=state.get("saved_at",0)
+        logger.info("Restored checkpoint rooms="+str(len(restored))
+                    +" age secs="+str(int(time.time()-self.saved_at)))
+        return restored
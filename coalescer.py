@@ -0,0 +1,82 @@
+from threading import Lock,Timer
+import mylogger
+import metrics
+
+logger = mylogger.getlogger(__name__)
+
+COALESCE_WINDOW_MS=500
+FLUSH_MAX_ATTEMPTS=3
+FLUSH_RETRY_DELAY=1  #secs, doubled on each attempt
+
+#notifications and how many were coalesced are counted by gcalwatch in
+#roomcal_webhook_notifications_total{outcome}
+FLUSHES = metrics.counter("roomcal_webhook_flushes_total","Coalescing windows processed")
+
+
+class WebhookCoalescer:
+
+    #the first notification for a calendar schedules the work for when the
+    #window has passed and returns right away; notifications arriving in the
+    #meantime only record the highest message number. The work runs in a
+    #timer thread, so request threads are never held for the window
+
+    def __init__(self):
+        self.pending={}  #calendar_id -> {"message_number","count"}
+        self.lock=Lock()
+        self.active=0  #windows scheduled and not yet processed
+
+
+    def submit(self,calendar_id,message_number,process,window_ms=COALESCE_WINDOW_MS):
+        #returns True if this call scheduled process(message_number,count)
+        with self.lock:
+            entry = self.pending.get(calendar_id)
+            if entry is not None:
+                entry["message_number"]=max(entry["message_number"],message_number)
+                entry["count"]=entry["count"]+1
+                return False
+            entry = {"message_number":message_number,"count":1}
+            self.pending[calendar_id]=entry
+            self.active=self.active+1
+        timer = Timer(window_ms/1000.0,self.flush,args=[calendar_id,entry,process])
+        timer.name = "coalesce_flush"
+        timer.start()
+        return True
+
+
+    def flush(self,calendar_id,entry,process):
+        #from now on a new notification starts a new window, so changes
+        #made while process runs are not lost
+        with self.lock:
+            del self.pending[calendar_id]
+        FLUSHES.inc()
+        self.run(calendar_id,entry,process,1)
+
+
+    def run(self,calendar_id,entry,process,attempt):
+        #a failed window is processed again later, the window stays active
+        #until it succeeds or is given up
+        logger.info("Processing calendar "+calendar_id+" notifications="+str(entry["count"])
+                    +" message_number="+str(entry["message_number"])+" attempt="+str(attempt))
+        try:
+            process(entry["message_number"],entry["count"])
+        except Exception as e:
+            if attempt<FLUSH_MAX_ATTEMPTS:
+                metrics.API_RETRIES.labels(api="calendar",reason="error").inc()
+                delay = FLUSH_RETRY_DELAY*(2**(attempt-1))
+                logger.error("Unable to process notifications of calendar "+calendar_id
+                             +", retrying in "+str(delay)+" secs: {}".format(e))
+                timer = Timer(delay,self.run,args=[calendar_id,entry,process,attempt+1])
+                timer.name = "coalesce_retry"
+                timer.start()
+                return
+            logger.error("Unable to process notifications of calendar "+calendar_id
+                         +" after "+str(attempt)+" attempts: {}".format(e))
+            metrics.API_FAILURES.labels(api="calendar",op="webhook_flush").inc()
+        with self.lock:
+            self.active=self.active-1
+
+
+    def is_idle(self):
+        #no window pending or being processed
+        with self.lock:
+            return self.active==0
@@ -0,0 +1,85 @@
+from threading import Lock
+import json
+import time
+import mylogger
+import metrics
+
+logger = mylogger.getlogger(__name__)
+
+CONFIG_TTL=30  #secs a cached config is used before checking the blob generation
+
+
+class RoomConfig:
+
+    #parsed config.json with O(1) lookups between room names and calendar ids
+
+    def __init__(self,config,generation=None):
+        self.config=config
+        self.generation=generation
+        self.rooms=config.get("rooms",[])
+        self.room_by_calendar={}
+        self.calendar_by_room={}
+        for room in self.rooms:
+            room_name = room.get("room_name","")
+            calendar_id = room.get("gcal_calendar_id","")
+            self.room_by_calendar[calendar_id]=room_name
+            self.calendar_by_room[room_name]=calendar_id
+
+
+    def get(self,key,default=None):
+        return self.config.get(key,default)
+
+
+    def get_room_name(self,calendar_id):
+        return self.room_by_calendar.get(calendar_id,"")
+
+
+    def get_calendar_id(self,room_name):
+        return self.calendar_by_room.get(room_name,"")
+
+
+class ConfigCache:
+
+    def __init__(self,get_storage_client,bucket_name,blob_name="config.json",ttl=CONFIG_TTL):
+        self.get_storage_client=get_storage_client
+        self.bucket_name=bucket_name
+        self.blob_name=blob_name
+        self.ttl=ttl
+        self.lock=Lock()
+        self.current=None
+        self.checked_at=0
+        self.downloads=0
+
+
+    def get(self):
+        current = self.current
+        if current is not None and time.time()<self.checked_at+self.ttl:
+            return current
+        with self.lock:
+            #another thread may have revalidated while we were waiting
+            if self.current is None or time.time()>=self.checked_at+self.ttl:
+                self.revalidate()
+            return self.current
+
+
+    def revalidate(self):
+        try:
+            bucket = self.get_storage_client().bucket(self.bucket_name)
+            #metadata only, the content is downloaded when the generation changes
+            with metrics.timed("gcs","config_metadata"):
+                blob = bucket.get_blob(self.blob_name)
+            if blob is None:
+                raise FileNotFoundError(self.bucket_name+"/"+self.blob_name)
+            if self.current is None or blob.generation!=self.current.generation:
+                with metrics.timed("gcs","config_download"):
+                    config = json.loads(blob.download_as_bytes(if_generation_match=blob.generation))
+                self.current = RoomConfig(config,blob.generation)
+                self.downloads = self.downloads+1
+                logger.info("Loaded "+self.blob_name+" generation="+str(blob.generation))
+            self.checked_at=time.time()
+        except Exception as e:
+            if self.current is None:
+                raise
+            #keep the last known config, check again after ttl
+            logger.error("Unable to revalidate "+self.blob_name+": {}".format(e))
+            self.checked_at=time.time()
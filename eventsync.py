@@ -0,0 +1,181 @@
+from threading import Lock
+from datetime import datetime,timezone,timedelta
+from googleapiclient.errors import HttpError
+from timeline import parse_event_time
+import time
+import mylogger
+import metrics
+
+logger = mylogger.getlogger(__name__)
+
+SYNC_WINDOW_DAYS=31  #events fetched by a full sync, starting from now
+FULL_SYNC_INTERVAL=24*3600  #full sync is redone so the window moves forward
+PAGE_SIZE=250
+
+SYNCS = metrics.counter("roomcal_calendar_syncs_total","Calendar event syncs",("mode",))
+
+
+class CalendarSyncState:
+
+    def __init__(self):
+        self.events={}  #event id -> event
+        self.sync_token=None
+        self.full_sync_at=0
+        self.lock=Lock()
+
+
+class EventSync:
+
+    #keeps per calendar the events and the nextSyncToken of the last list,
+    #so that later refreshes only transfer what changed
+
+    def __init__(self):
+        self.states={}
+        self.lock=Lock()
+
+
+    def get_state(self,calendar_id):
+        with self.lock:
+            state = self.states.get(calendar_id)
+            if state is None:
+                state = CalendarSyncState()
+                self.states[calendar_id]=state
+            return state
+
+
+    def sync(self,service,calendar_id,num_events=10):
+        #returns the next num_events not yet ended, ordered by start time
+        state = self.get_state(calendar_id)
+        with state.lock:
+            if self.needs_full_sync(state):
+                self.full_sync(service,calendar_id,state)
+            else:
+                try:
+                    self.incremental_sync(service,calendar_id,state)
+                except HttpError as e:
+                    if e.resp.status!=410:
+                        raise
+                    #sync token expired or invalidated by the server
+                    logger.info("Sync token gone for "+calendar_id+", doing full sync")
+                    self.full_sync(service,calendar_id,state)
+            return self.upcoming(state,num_events)
+
+
+    def list_pages(self,service,params):
+        items=[]
+        page_token=None
+        while True:
+            if page_token is not None:
+                params["pageToken"]=page_token
+            op = "events_sync" if "syncToken" in params else "events_list"
+            with metrics.timed("calendar",op):
+                result = service.events().list(**params).execute()
+            items.extend(result.get('items',[]))
+            page_token = result.get('nextPageToken')
+            if page_token is None:
+                return items,result.get('nextSyncToken')
+
+
+    def full_params(self,calendar_id):
+        now = datetime.now(timezone.utc)
+        return {
+            "calendarId":calendar_id,
+            "timeMin":now.isoformat(),
+            "timeMax":(now+timedelta(days=SYNC_WINDOW_DAYS)).isoformat(),
+            "singleEvents":True,
+            "maxResults":PAGE_SIZE
+        }
+
+
+    def incremental_params(self,calendar_id,sync_token):
+        return {
+            "calendarId":calendar_id,
+            "syncToken":sync_token,
+            "singleEvents":True,
+            "maxResults":PAGE_SIZE
+        }
+
+
+    def needs_full_sync(self,state):
+        return state.sync_token is None or time.time()>state.full_sync_at+FULL_SYNC_INTERVAL
+
+
+    def full_sync(self,service,calendar_id,state):
+        items,sync_token = self.list_pages(service,self.full_params(calendar_id))
+        self.apply_full(calendar_id,state,items,sync_token)
+
+
+    def apply_full(self,calendar_id,state,items,sync_token):
+        state.events={}
+        self.apply(state,items)
+        state.sync_token=sync_token
+        state.full_sync_at=time.time()
+        SYNCS.labels(mode="full").inc()
+        if sync_token is None:
+            logger.info("No sync token returned for "+calendar_id+", next sync will be full")
+        logger.info("Full sync of "+calendar_id+" events="+str(len(state.events)))
+
+
+    def incremental_sync(self,service,calendar_id,state):
+        items,sync_token = self.list_pages(service,self.incremental_params(calendar_id,state.sync_token))
+        self.apply_incremental(calendar_id,state,items,sync_token)
+
+
+    def apply_incremental(self,calendar_id,state,items,sync_token):
+        self.apply(state,items)
+        state.sync_token=sync_token
+        SYNCS.labels(mode="incremental").inc()
+        logger.info("Incremental sync of "+calendar_id+" changes="+str(len(items)))
+
+
+    def batch_params(self,calendar_id):
+        #list parameters for the next sync of calendar_id, when it is sent
+        #as part of a batch request
+        state = self.get_state(calendar_id)
+        with state.lock:
+            if self.needs_full_sync(state):
+                return self.full_params(calendar_id)
+            return self.incremental_params(calendar_id,state.sync_token)
+
+
+    def apply_batch_result(self,calendar_id,params,result,num_events=10):
+        #returns the upcoming events, or None when the single page result of
+        #a batch cannot be used and the calendar has to be synced on its own
+        if result.get('nextPageToken') is not None:
+            return None
+        state = self.get_state(calendar_id)
+        with state.lock:
+            if "syncToken" not in params:
+                self.apply_full(calendar_id,state,result.get('items',[]),result.get('nextSyncToken'))
+            elif state.sync_token==params["syncToken"]:
+                self.apply_incremental(calendar_id,state,result.get('items',[]),result.get('nextSyncToken'))
+            else:
+                #synced by somebody else in the meantime
+                return None
+            return self.upcoming(state,num_events)
+
+
+    def apply(self,state,items):
+        for item in items:
+            if item.get("status")=="cancelled":
+                state.events.pop(item.get("id"),None)
+            else:
+                state.events[item["id"]]=item
+
+
+    def upcoming(self,state,num_events):
+        now = time.time()
+        timed=[]
+        for event in state.events.values():
+            try:
+                start = parse_event_time(event['start'].get('dateTime', event['start'].get('date'))).timestamp()
+                end = parse_event_time(event['end'].get('dateTime', event['end'].get('date'))).timestamp()
+            except (KeyError,ValueError):
+                continue
+            if end>now:
+                timed.append((start,event))
+        timed.sort(key=lambda t: t[0])
+        return [t[1] for t in timed[:num_events]]
+
+
+event_sync = EventSync()
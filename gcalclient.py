@@ -1,17 +1,13 @@
 from roomstatus import RoomStatus
-from datetime import datetime,timezone,timedelta
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google.oauth2 import service_account
-from google.auth import default 
-from googleapiclient.discovery import build
+from timeline import EventTimeline
+from datetime import datetime,timedelta
 from googleapiclient.errors import HttpError
-from google.cloud import storage
-import json
+from gcalservice import get_calendar_service
+from eventsync import event_sync
 import socket
 import mylogger
-import sys
-from time import time,sleep
+import metrics
+from time import sleep
 
 BUCKET_NAME = "roomcalendar-config"
 
@@ -25,6 +21,7 @@ logger = mylogger.getlogger(__name__)
 
 RETRY_DELAY_GCAL = 1
 MAX_ATTEMPTS=3
+BATCH_SIZE=50  #max requests per Calendar API batch
 
 class GCalClient:
 
@@ -37,32 +34,8 @@ class GCalClient:
         return
 
 
-    def set_nextev_dates(self,startd,endd,tomorrow,result):
-        #utility to set next events dates in right format
-        #if it's within the day use only H:M otherwise put day in front
-        if (startd<tomorrow):
-            result.nextevstart = datetime.strftime(startd,"%H:%M")
-            result.nextevend = datetime.strftime(endd,"%H:%M")
-            result.nextevtm=result.nextevstart+"-"+result.nextevend
-        else: 
-            enddayofmonth = datetime.strftime(endd,"%Y-%m-%d")
-            startdayofmonth=datetime.strftime(startd,"%Y-%m-%d")
-            if (enddayofmonth!=startdayofmonth):
-                #this is a multi-day event
-                #and it is in progress, hence the current day is
-                #fully busy
-                result.nextevend = datetime.strftime(endd,"%b %d")
-                result.nextevstart = datetime.strftime(startd,"%b %d")
-                result.nextevtm = result.nextevstart+"-"+result.nextevend
-            else:
-                result.nextevstart = datetime.strftime(startd,"%Y-%m-%d %H:%M")
-                result.nextevend = datetime.strftime(endd,"%H:%M")
-                result.nextevtm = datetime.strftime(startd,"%a %d %b %H:%M") \
-                                +"-"+result.nextevend
-        
-
-    def get_next_events(self):
-        
+    def get_next_events(self,incremental=False):
+        #incremental keeps the calendar events in memory and only fetches changes
         events=()
         attempts = 1
         retrievedok = False
@@ -70,14 +43,17 @@ class GCalClient:
             try:
                 logger.info('Getting the upcoming events')
                 service=self.get_gcalclient()
-                now = datetime.utcnow().isoformat() + 'Z'  # 'Z' indicates UTC time    
-                events_result = service.events().list(
-                        calendarId=self.calendarId,  \
-                        timeMin=now,  \
-                        maxResults=10, singleEvents=True,\
-                        orderBy='startTime').execute()
-                
-                events = events_result.get('items', [])
+                if incremental:
+                    events = event_sync.sync(service,self.calendarId)
+                else:
+                    now = datetime.utcnow().isoformat() + 'Z'  # 'Z' indicates UTC time    
+                    with metrics.timed("calendar","events_list"):
+                        events_result = service.events().list(
+                                calendarId=self.calendarId,  \
+                                timeMin=now,  \
+                                maxResults=10, singleEvents=True,\
+                                orderBy='startTime').execute()
+                    events = events_result.get('items', [])
                 logger.debug(events)
                 retrievedok = True
             except (RuntimeError,TimeoutError,socket.timeout) as error:
@@ -87,11 +63,63 @@ class GCalClient:
                 retrievedok=False
                 logger.error('GCALCLIENT: Unexpected error: %s', e)
             if not retrievedok:
+                metrics.API_RETRIES.labels(api="calendar",reason="error").inc()
                 sleep(RETRY_DELAY_GCAL)
                 attempts=attempts+1
+        if not retrievedok:
+            metrics.API_FAILURES.labels(api="calendar",op="get_next_events").inc()
         return events
 
 
+    @staticmethod
+    def get_next_events_batch(calendars,incremental=False):
+        #fetches the next events of many calendars, calendars is a dict
+        #room_name -> calendar_id; rooms are sent in chunks through the
+        #Calendar batch endpoint, failed requests are retried one by one
+        results={}
+        items=list(calendars.items())
+        try:
+            service=get_calendar_service()
+        except Exception as e:
+            logger.error('GCALCLIENT: Unable to get calendar service for batch: %s', e)
+            items=[]
+        for pos in range(0,len(items),BATCH_SIZE):
+            chunk=dict(items[pos:pos+BATCH_SIZE])
+            params={}
+
+            def callback(request_id,response,exception):
+                if exception is not None:
+                    logger.error('GCALCLIENT: Batch request for %s failed: %s',request_id,exception)
+                    return
+                if incremental:
+                    events = event_sync.apply_batch_result(chunk[request_id],params[request_id],response)
+                    if events is not None:
+                        results[request_id]=events
+                else:
+                    results[request_id]=response.get('items',[])
+
+            batch = service.new_batch_http_request(callback=callback)
+            for room_name,calendar_id in chunk.items():
+                if incremental:
+                    params[room_name]=event_sync.batch_params(calendar_id)
+                else:
+                    now = datetime.utcnow().isoformat() + 'Z'  # 'Z' indicates UTC time
+                    params[room_name]={"calendarId":calendar_id,"timeMin":now,
+                                       "maxResults":10,"singleEvents":True,"orderBy":'startTime'}
+                batch.add(service.events().list(**params[room_name]),request_id=room_name)
+            try:
+                logger.info('Getting the upcoming events for '+str(len(chunk))+' calendars in batch')
+                with metrics.timed("calendar","batch"):
+                    batch.execute()
+            except Exception as e:
+                logger.error('GCALCLIENT: Batch request failed: %s', e)
+
+        for room_name,calendar_id in calendars.items():
+            if room_name not in results:
+                results[room_name]=GCalClient(calendar_id,room_name).get_next_events(incremental)
+        return results
+
+
     def get_calendar_status(self):
         result = RoomStatus()
         events = self.get_next_events()
@@ -100,115 +128,13 @@ class GCalClient:
             result.valid = False 
             result.name = self.room_name
             return result
-        result = self.get_calendar_status_from_events(events)
-        return result
-
-
-    def get_calendar_status_from_events(self,events):
-        result = RoomStatus()
-        result.valid = True
-        result.name=self.room_name
-        
-        if not events:
-            logger.debug('No upcoming events found.')
-            return result
-
-        # Fetches the first 2 events
-        evno = 0
-        organizer = ""
-        eventid = ""
-        for event in events:
-            start = event['start'].get('dateTime', event['start'].get('date'))
-            end = event['end'].get('dateTime', event['end'].get('date'))
-            status='confirmed'
-            if 'attendees' in event:
-                attendees = event['attendees']
-                for attendee in attendees:
-                    #look for the attendee with key 'self' which
-                    #is the owner of this calendar
-                    #and check if it was accepted
-                    if 'self' in attendee:
-                        status = attendee['responseStatus']
-                    if "organizer" in attendee and attendee["organizer"] is True:
-                        organizer = attendee["email"]
-            eventid = event['id']
-            summary = "Private Meeting"
-            if "summary" in event:
-                    summary = event["summary"]
-            logger.debug(f"Event summary {summary} status: {status}")
-
-            startd=datetime.strptime(start,"%Y-%m-%dT%H:%M:%S%z")
-            endd=datetime.strptime(end,"%Y-%m-%dT%H:%M:%S%z")
-
-            tomorrow = datetime.now(timezone.utc) \
-                        .replace(hour=0, minute=0, second=0, microsecond=0) \
-                        + timedelta(days=1)
-
-            if status!='declined':
-                #we will count and consider only accepted events
-                evno = evno+1
-
-            if status!='declined' and evno==1:
-                #first event will tell if room is busy
-                #if started before now, event is current
-                if (startd<datetime.now(timezone.utc)):
-                    result.busynow = RoomStatus.BUSY
-                    result.curevmsg = summary
-                    result.curevorganizer = organizer
-                    result.curevid = eventid
-                    enddayofmonth = datetime.strftime(endd,"%Y-%m-%d")
-                    startdayofmonth=datetime.strftime(startd,"%Y-%m-%d")
-                    if (enddayofmonth!=startdayofmonth):
-                        #this is a multi-day event
-                        #and it is in progress, hence the current day is
-                        #fully busy
-                        result.curevend = datetime.strftime(endd,"%b %d")
-                        result.curevstart = datetime.strftime(startd,"%b %d")
-                        result.curevtm = result.curevstart+"-"+result.curevend
-                    else:
-                        result.curevend = datetime.strftime(endd,"%H:%M")
-                        result.curevstart = datetime.strftime(startd,"%H:%M")
-                        result.curevtm = result.curevstart+"-"+result.curevend
-                else:
-                    #didn't start before now. will it start today ? 
-                    #if starts today, calculate free until time
-                    result.busynow = RoomStatus.FREE
-                    if (startd<tomorrow):
-                        result.curevmsg = "Free until "+datetime.strftime(startd,"%H:%M")
-                    else: 
-                        #else is free all day
-                        result.curevmsg = "Free all day"
-                            
-                    #sets next events details
-                    self.set_nextev_dates(startd,endd,tomorrow,result)
-                    result.nextevmsg = summary
-                    result.nextevorganizer=organizer 
-                    result.nextevid = eventid
-                    
-            if status!='declined' and evno==2:
-                #second event is useful only if room is busy to set next mtg details
-                if result.busynow==RoomStatus.BUSY:
-                    result.nextevmsg = summary
-                    result.nextevid = eventid 
-                    self.set_nextev_dates(startd,endd,tomorrow,result)
-                    result.nextevorganizer=organizer 
-
-        return result
+        #same computation as the updater, see timeline
+        return EventTimeline.from_events(events).status_at(self.room_name)
 
 
     def get_gcalclient(self):
-        creds,project_id = default(scopes=SCOPES)
-        storage_client = storage.Client(credentials=creds)
-        bucket = storage_client.bucket(BUCKET_NAME)
-        blob = bucket.blob("calendar_credentials.json")
-        with blob.open("r") as f:
-            info = json.load(f)
-    
-        creds = service_account.Credentials.from_service_account_info(info=info)
-        creds = creds.with_scopes(scopes=SCOPES)
-        logger.debug("Credentials "+creds.service_account_email) 
-        service = build('calendar', 'v3', credentials=creds)
-        return service
+        #process wide, thread safe service, see gcalservice
+        return get_calendar_service()
 
      
 
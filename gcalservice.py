@@ -0,0 +1,96 @@
+from threading import Lock,local
+from google.oauth2 import service_account
+from google.auth import default
+from googleapiclient.discovery import build
+from googleapiclient.http import HttpRequest
+from google.cloud import storage
+import google_auth_httplib2
+import httplib2
+import json
+import time
+import mylogger
+
+logger = mylogger.getlogger(__name__)
+
+BUCKET_NAME = "roomcalendar-config"
+CREDENTIALS_BLOB = "calendar_credentials.json"
+
+SCOPES = ['https://www.googleapis.com/auth/pubsub',
+        'https://www.googleapis.com/auth/devstorage.read_write',
+        'https://www.googleapis.com/auth/calendar',
+        'https://www.googleapis.com/auth/calendar.events']
+
+#how often the credentials blob generation is checked, metadata only
+REVALIDATE_INTERVAL=300
+
+
+def build_calendar_service(creds):
+    #httplib2 connections are not thread safe, so each thread gets its own
+    #authorized connection which is then reused across its requests
+    connections = local()
+
+    def get_http():
+        http = getattr(connections,"http",None)
+        if http is None:
+            http = google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http())
+            connections.http = http
+        return http
+
+    def build_request(http, *args, **kwargs):
+        return HttpRequest(get_http(), *args, **kwargs)
+
+    #discovery document shipped with the client library, no HTTP fetch
+    return build('calendar', 'v3', http=get_http(), requestBuilder=build_request,
+                 static_discovery=True, cache_discovery=False)
+
+
+class CalendarServiceFactory:
+
+    def __init__(self,bucket_name=BUCKET_NAME,blob_name=CREDENTIALS_BLOB):
+        self.bucket_name=bucket_name
+        self.blob_name=blob_name
+        self.lock=Lock()
+        self.storage_client=None
+        self.service=None
+        self.generation=None
+        self.checked_at=0
+        self.builds=0
+
+
+    def get_service(self):
+        with self.lock:
+            if self.service is None or time.time()>self.checked_at+REVALIDATE_INTERVAL:
+                self.revalidate()
+            return self.service
+
+
+    def revalidate(self):
+        try:
+            if self.storage_client is None:
+                creds,project_id = default(scopes=SCOPES)
+                self.storage_client = storage.Client(credentials=creds)
+            blob = self.storage_client.bucket(self.bucket_name).get_blob(self.blob_name)
+            if blob is None:
+                raise FileNotFoundError(self.bucket_name+"/"+self.blob_name)
+            if self.service is None or blob.generation!=self.generation:
+                info = json.loads(blob.download_as_bytes(if_generation_match=blob.generation))
+                creds = service_account.Credentials.from_service_account_info(info=info)
+                creds = creds.with_scopes(scopes=SCOPES)
+                logger.debug("Credentials "+creds.service_account_email)
+                self.service = build_calendar_service(creds)
+                self.generation = blob.generation
+                self.builds = self.builds+1
+                logger.info("Calendar service built, credentials generation="+str(blob.generation))
+            self.checked_at=time.time()
+        except Exception as e:
+            if self.service is None:
+                raise
+            #keep serving with the current credentials, check again later
+            logger.error("Unable to revalidate calendar credentials: {}".format(e))
+            self.checked_at=time.time()
+
+
+factory = CalendarServiceFactory()
+
+def get_calendar_service():
+    return factory.get_service()
@@ -1,19 +1,21 @@
 import datetime
 import json
+import os
+import time
 import mylogger
-from gcalclient import GCalClient
+import metrics
+import tracing
+from configcache import ConfigCache
+from coalescer import WebhookCoalescer,COALESCE_WINDOW_MS
+from channelmanager import ChannelManager
+from wireformat import encode_room_events,ATTR_NOTIFIED
+from threading import Lock,Timer,Thread
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, request, jsonify, abort
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google.auth import default 
-from googleapiclient.discovery import build
-from google.auth.exceptions import RefreshError
-from google.cloud import storage
-from google.oauth2 import service_account
-from google.cloud import pubsub_v1
 import urllib.parse
 from roomstatus import RoomStatus
-
+#Google client libraries take most of the startup time: they are imported
+#by the functions that first need them (see prewarm)
 
 SCOPES = ['https://www.googleapis.com/auth/calendar',
         'https://www.googleapis.com/auth/calendar.events',
@@ -25,34 +27,145 @@ BUCKET_NAME = "roomcalendar-watch-ids"
 CONFIG_BUCKET_NAME="roomcalendar-config"
 TOPIC_NAME="roomcalendar_events"
 WATCH_ID="gcalwatch_v5"
+PUBLISH_MAX_ATTEMPTS=3
+PUBLISH_RETRY_DELAY=1  #secs, doubled on each attempt
+WATCH_WORKERS=8  #parallel watch requests of a bulk /start_watching_all
 
 app = Flask(__name__)
+tracing.tracer.configure(service_name="gcalwatch")
 
 logger = mylogger.getlogger(__name__)
 
+NOTIFICATIONS = metrics.counter("roomcal_webhook_notifications_total","Calendar notifications received",("outcome",))
+NOTIFICATION_TO_PUBLISH = metrics.histogram("roomcal_notification_to_publish_seconds",
+                                            "From calendar notification to room events published",("room",))
+
+storage_client = None
+storage_client_lock = Lock()
+
+def get_storage_client():
+    #one storage client per process, shared by all request threads
+    global storage_client
+    with storage_client_lock:
+        if storage_client is None:
+            from google.cloud import storage
+            storage_client = storage.Client(credentials=get_credentials())
+        return storage_client
+
+calendar_client = None
+calendar_client_lock = Lock()
+
+def get_calendar_client():
+    #one thread safe calendar service per process, see gcalservice
+    global calendar_client
+    with calendar_client_lock:
+        if calendar_client is None:
+            from gcalservice import build_calendar_service
+            calendar_client = build_calendar_service(get_credentials())
+        return calendar_client
+
+config_cache = ConfigCache(get_storage_client,CONFIG_BUCKET_NAME)
+webhook_coalescer = WebhookCoalescer()
+channel_manager = ChannelManager(get_storage_client,BUCKET_NAME,WATCH_ID)
+
+fetch_locks = {}
+fetch_locks_lock = Lock()
+
+def get_fetch_lock(calendar_id):
+    with fetch_locks_lock:
+        lock = fetch_locks.get(calendar_id)
+        if lock is None:
+            lock = Lock()
+            fetch_locks[calendar_id]=lock
+        return lock
+
+publisher = None
+topic_path = ""
+publisher_lock = Lock()
+
+def get_publisher():
+    #one publisher per process: its gRPC channel and batching threads are
+    #reused by every webhook instead of being set up for each notification
+    global publisher,topic_path
+    with publisher_lock:
+        if publisher is None:
+            from google.cloud import pubsub_v1
+            creds = get_credentials()
+            batch_settings = pubsub_v1.types.BatchSettings(
+                max_messages=100,
+                max_bytes=1024*1024,
+                max_latency=0.01  #a webhook should not wait for a batch to fill
+            )
+            #room name is used as ordering key, so messages of a room are
+            #delivered in publish order (subscription must enable ordering)
+            publisher_options = pubsub_v1.types.PublisherOptions(enable_message_ordering=True)
+            publisher = pubsub_v1.PublisherClient(batch_settings=batch_settings,
+                                                  publisher_options=publisher_options,
+                                                  credentials=creds)
+            topic_path = "projects/"+creds.project_id+"/topics/"+TOPIC_NAME
+        return publisher,topic_path
+
+
+def publish_message(data,room_name,attributes=None,attempt=1,span=None):
+    #enqueues the message and returns, the outcome is handled in on_published
+    if attributes is None:
+        attributes = {}
+    if span is None:
+        #ends when the publish succeeds or is given up, retries included;
+        #updater continues the trace from this span
+        span = tracing.start_span("publish",None,{"room":room_name})
+        attributes[tracing.ATTR_TRACEPARENT]=span.context().to_traceparent()
+    publisher,topic_path = get_publisher()
+    start = time.monotonic()
+    future = publisher.publish(topic_path, data, ordering_key=room_name, **attributes)
+    future.add_done_callback(lambda f: on_published(f,data,room_name,attributes,attempt,start,span))
+    return future
+
+
+def on_published(future,data,room_name,attributes,attempt,start,span):
+    metrics.API_DURATION.labels(api="pubsub",op="publish").observe(time.monotonic()-start)
+    span.set_attribute("attempts",attempt)
+    try:
+        result = future.result()
+        metrics.API_CALLS.labels(api="pubsub",op="publish",outcome="ok").inc()
+        logger.info(f"Published message for room {room_name} to {topic_path} - {result}")
+        span.set_attribute("message_id",result)
+        span.end()
+        if ATTR_NOTIFIED in attributes:
+            notified_at = int(attributes[ATTR_NOTIFIED])/1000000.0
+            NOTIFICATION_TO_PUBLISH.labels(room=room_name).observe(max(0,time.time()-notified_at))
+    except Exception as e:
+        metrics.API_CALLS.labels(api="pubsub",op="publish",outcome="error").inc()
+        if attempt>=PUBLISH_MAX_ATTEMPTS:
+            logger.error(f"Unable to publish message for room {room_name} after {attempt} attempts: {e}")
+            metrics.API_FAILURES.labels(api="pubsub",op="publish").inc()
+            span.set_error(e)
+            span.end()
+            return
+        metrics.API_RETRIES.labels(api="pubsub",reason="error").inc()
+        #a failed publish pauses its ordering key until resumed
+        publisher.resume_publish(topic_path,room_name)
+        delay = PUBLISH_RETRY_DELAY*(2**(attempt-1))
+        logger.error(f"Publish failed for room {room_name}, retrying in {delay} secs: {e}")
+        Timer(delay,publish_message,args=[data,room_name,attributes,attempt+1,span]).start()
+
  
 # Function to get the next events from now
-def get_next_events(calendar_client,calendar_id, num_events=10):
+def get_next_events(calendar_client,calendar_id, num_events=10, incremental=False):
     logger.info("Extracting events from calendar "+calendar_id)
+    if incremental:
+        #only changes since the previous notification are transferred
+        from eventsync import event_sync
+        return event_sync.sync(calendar_client,calendar_id,num_events)
     now = datetime.datetime.utcnow().isoformat() + 'Z' # 'Z' indicates UTC time
-    events_result = calendar_client.events().list(calendarId=calendar_id, timeMin=now,
-                                        maxResults=num_events, singleEvents=True,
-                                        orderBy='startTime').execute()
+    with metrics.timed("calendar","events_list"):
+        events_result = calendar_client.events().list(calendarId=calendar_id, timeMin=now,
+                                            maxResults=num_events, singleEvents=True,
+                                            orderBy='startTime').execute()
     events = events_result.get('items', [])
     return events
 
 
-def watch_calendar(calendar_client,calendar_id,url):
-    logger.info("Starting to watch "+calendar_id+" watchid="+WATCH_ID)
-    request = calendar_client.events().watch(calendarId=calendar_id, body={
-        'id': WATCH_ID,
-        'type': 'web_hook',
-        'address': url
-    })
-    response = request.execute()
-    logger.info(response)
-    return response
-
 def unwatch_calendar(calendar_client,watch_id,resource_id):
     request = calendar_client.channels().stop(body={                          
         'id': watch_id,
@@ -62,18 +175,8 @@ def unwatch_calendar(calendar_client,watch_id,resource_id):
     response = request.execute()
     return response
 
-def store_watch_resourceid(storage_client,room_name,response):
-    bucket = storage_client.bucket(BUCKET_NAME)
-    objname=room_name+".json"
-    content = {
-        "response":response
-    }
-    blob = bucket.blob(objname)
-    with blob.open("w") as f:
-        json.dump(content,f)
-    
-
 def read_watch_resourceid(storage_client,room_name):
+    #per room blobs written before channels were tracked by ChannelManager
     bucket = storage_client.bucket(BUCKET_NAME)
     objname=room_name+".json"
     blob = bucket.blob(objname)
@@ -107,6 +210,7 @@ def extract_calendar_id(calendar_uri):
 def get_credentials():
     #test only 
     #creds = service_account.Credentials.from_service_account_file("credentials.json", scopes=SCOPES)
+    from google.auth import default
     creds, project_id = default(scopes=SCOPES)
     creds.project_id=project_id
     logger.debug("Get credentials "+creds.project_id)
@@ -114,52 +218,119 @@ def get_credentials():
 
 #################### routes
 
+def authorize_get():
+    #GET endpoints take client_id as query parameter and the secret as Bearer
+    #token, like the other endpoints only the configured client is allowed
+    client_id = request.args.get("client_id","")
+    authh = request.headers.get("Authorization","Bearer ")
+    client_secret = authh[7:len(authh)]
+    if client_secret=="" or client_id=="":
+        abort(400,"Required parameters in request are missing")
+
+    #retrieve config
+    config = config_cache.get()
+    config_client_id=config.get("iot_client_id","")
+    #allow only requests with the same client_id as the one configured
+    if client_id!=config_client_id:
+        abort(401,"ERROR - Client not authorized")
+    return config
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    #Prometheus text format, see metrics; labels include room names
+    authorize_get()
+    return metrics.render(),200,{"Content-Type":metrics.CONTENT_TYPE}
+
+
+@app.route('/traces', methods=['GET'])
+def get_traces():
+    #recent spans as OTLP JSON, optionally of a single trace; attributes
+    #include calendar ids and room names
+    authorize_get()
+    return tracing.tracer.render(request.args.get("trace_id")),200,{"Content-Type":"application/json"}
+
+
 # Function to handle webhook notifications
 @app.route('/webhook', methods=['POST'])
 def handle_webhook():
     logger.info("Webhook Notification Received:")
+    notified_at = int(time.time()*1000000)
     props = dict(request.headers)
     logger.info(props)
-    if props["X-Goog-Channel-Id"]!=WATCH_ID:
+    #each notification starts a trace, passed to updater with the room events
+    with tracing.span("webhook",None,**{"gcal.channel_id":props.get("X-Goog-Channel-Id",""),
+                                        "gcal.message_number":props.get("X-Goog-Message-Number",""),
+                                        "gcal.resource_state":props.get("X-Goog-Resource-State","")}) as span:
+        outcome = process_notification(props,notified_at)
+        span.set_attribute("outcome",outcome)
+    NOTIFICATIONS.labels(outcome=outcome).inc()
+    return jsonify({'status': 'success'})
+
+
+def process_notification(props,notified_at):
+    #returns what was done with the notification
+    if not channel_manager.is_current_channel_id(props["X-Goog-Channel-Id"]):
         logger.info("Ignoring notification, was for different watchid version "+props["X-Goog-Channel-Id"])
-        return jsonify({'status': 'success'})
+        return "other_channel"
+
+    if props.get("X-Goog-Resource-State","")=="sync":
+        #sent once when a channel is created, nothing changed in the calendar
+        logger.info("Ignoring sync notification")
+        return "sync"
 
     calendar_uri = props["X-Goog-Resource-Uri"]
     #this is the full URI of the calendar so we need to strip out some parts
     calendar_id = extract_calendar_id(calendar_uri)
     
-    storage_client = storage.Client(credentials=get_credentials())
     #retrieve config
-    bucket = storage_client.bucket(CONFIG_BUCKET_NAME)
-    blob = bucket.blob("config.json")
-    with blob.open("r") as f:
-        config = json.load(f)
+    config = config_cache.get()
+    room_name=config.get_room_name(calendar_id)
+    logger.info("Notification received for room "+room_name+" calendarid="+calendar_id
+                +" trace="+tracing.current().trace_id)
+    if room_name=="":
+        return "unknown_calendar"
+    tracing.current().set_attribute("room",room_name)
+    try:
+        message_number = int(props.get("X-Goog-Message-Number","0"))
+    except ValueError:
+        message_number = 0
+    #a single edit often produces a burst of notifications, only one
+    #fetch and publish is done per burst, after the window and off the
+    #request thread, so Google gets its answer right away
+    parent = tracing.current()
+    def flush(msgno,count):
+        #continues the trace of the first notification of the burst
+        with tracing.span("flush",parent,room=room_name,notifications=count):
+            publish_room_events(config,room_name,calendar_id,msgno,notified_at)
+    scheduled = webhook_coalescer.submit(calendar_id,message_number,flush,
+                                         config.get("webhook_coalesce_ms",COALESCE_WINDOW_MS))
+    return "processed" if scheduled else "coalesced"
+
+
+def publish_room_events(config,room_name,calendar_id,message_number,notified_at=None):
+    logger.info("Extracting events and sending message for room "+room_name)
     
-    rooms=config.get("rooms",[])
-    room_name=""
-    for room in rooms:
-       if room.get("gcal_calendar_id","")==calendar_id:
-           room_name=room.get("room_name","")
-    logger.info("Notification received for room "+room_name+" calendarid="+calendar_id)
-    if room_name!="":
-        logger.info("Extracting events and sending message for room "+room_name)
-        
-        creds = get_credentials()
-        calendar_client = build('calendar', 'v3', credentials=creds)
-        
-        events = get_next_events(calendar_client,calendar_id)
+    calendar_client = get_calendar_client()
+
+    #fetches of a calendar are serialized and the version is taken before
+    #the fetch, so a higher version always carries newer or equal events;
+    #publishing inside the lock keeps the ordering key in version order
+    with get_fetch_lock(calendar_id):
+        version = int(time.time()*1000000)
+        with tracing.span("fetch_events",calendar_id=calendar_id) as span:
+            events = get_next_events(calendar_client,calendar_id,
+                                     incremental=config.get("gcal_incremental_sync",True))
+            span.set_attribute("events",len(events))
         logger.info("Extracted "+json.dumps(events))
         
-        publisher = pubsub_v1.PublisherClient(credentials=creds)
-        projectid = creds.project_id
-        
-        topic_path = "projects/"+projectid+"/topics/"+TOPIC_NAME
-        data = json.dumps({ "room_name":room_name, "events":events })
-        future = publisher.publish(topic_path, data.encode('utf-8'))
-        result = future.result()
-        logger.info(f"Published message {data} to {topic_path} - {result}")
-        
-    return jsonify({'status': 'success'})
+        data,attributes = encode_room_events(room_name,events,version)
+        attributes["message_number"]=str(message_number)
+        if notified_at is not None:
+            #first notification of the burst, end to end latency is measured from it
+            attributes[ATTR_NOTIFIED]=str(notified_at)
+        publish_message(data,room_name,attributes)
+    logger.info(f"Enqueued message for room {room_name} bytes={len(data)} attributes={attributes}")
 
 
 @app.route('/start_watching',methods=['POST'])
@@ -173,53 +344,129 @@ def startwatching():
     if room_name=="" or client_secret=="" or client_id=="":
         abort(400,"Required parameters in request body are missing")
 
-    creds = get_credentials()
-    calendar_client = build('calendar', 'v3',credentials=creds)
-    storage_client = storage.Client(credentials=creds)
+    calendar_client = get_calendar_client()
+    storage_client = get_storage_client()
     
     #retrieve config
-    bucket = storage_client.bucket(CONFIG_BUCKET_NAME)
-    blob = bucket.blob("config.json")
-    with blob.open("r") as f:
-        config = json.load(f)
-    
-    
-    rooms=config.get("rooms",[])
+    config = config_cache.get()
     config_client_id=config.get("iot_client_id","")
     #allow only requests with the same client_id as the one configured
     if client_id!=config_client_id:
         abort(401,"ERROR - Client not authorized")
     
-    calendar_id = ""
-    for room in rooms:
-        if room.get("room_name","")==room_name:
-            calendar_id=room.get("gcal_calendar_id","")
+    calendar_id = config.get_calendar_id(room_name)
 
     if calendar_id=="":
         abort(400,"Required parameter not matching configuration for room_name="+room_name)
 
     logger.info("Executing request to watch room "+room_name)
     watch_url=config.get("gcal_watch_function_url","")+"/webhook"
-    #first, stop any existing watch created by this function to avoid double watching
-    ids = read_watch_resourceid(storage_client,room_name)
-    try:
-        #try unwatching
-        if "resource_id" in ids:
-            logger.info("Stopping to watch "+ids["watch_id"]+":"+ids["resource_id"])
-            unwatch_calendar(calendar_client,ids["watch_id"],ids["resource_id"])
-    except Exception as e:
-        logger.warn("Not able to unwatch calendar "+room_name)
-
-    #now setup a watch for this calendar
-    response = watch_calendar(calendar_client,calendar_id,watch_url)
-
-    #write watchid in cloud storage bucket
-    store_watch_resourceid(storage_client,room_name,response)
-    storage_client.close()
+    #channels may have been replaced by another instance since the last read
+    channel_manager.refresh()
+    response = watch_room(calendar_client,storage_client,room_name,calendar_id,watch_url)
     
     return jsonify(response)
 
 
+def watch_room(calendar_client,storage_client,room_name,calendar_id,watch_url,save=True):
+    #channels created before ChannelManager are stopped once to avoid double watching,
+    #later ones are stopped by ChannelManager when superseded
+    if channel_manager.get(room_name) is None:
+        ids = read_watch_resourceid(storage_client,room_name)
+        try:
+            #try unwatching
+            if "resource_id" in ids:
+                logger.info("Stopping to watch "+ids["watch_id"]+":"+ids["resource_id"])
+                unwatch_calendar(calendar_client,ids["watch_id"],ids["resource_id"])
+        except Exception as e:
+            logger.warn("Not able to unwatch calendar "+room_name)
+
+    #now setup a watch for this calendar, state is kept in the channels blob
+    return channel_manager.watch(calendar_client,room_name,calendar_id,watch_url,save)
+
+
+@app.route('/start_watching_all',methods=['POST'])
+def startwatching_all():
+    content = request.get_json(True)
+    #read auth data from request
+    client_id = content.get("client_id","")
+    #list of room names, all configured rooms if missing
+    room_names = content.get("room_names")
+    authh = request.headers.get("Authorization","Bearer ")
+    client_secret = authh[7:len(authh)]
+    if client_secret=="" or client_id=="":
+        abort(400,"Required parameters in request body are missing")
+
+    #retrieve config
+    config = config_cache.get()
+    config_client_id=config.get("iot_client_id","")
+    #allow only requests with the same client_id as the one configured
+    if client_id!=config_client_id:
+        abort(401,"ERROR - Client not authorized")
+    if room_names is None:
+        room_names = list(config.calendar_by_room.keys())
+    elif not isinstance(room_names,list) or not all(isinstance(name,str) for name in room_names):
+        abort(400,"room_names must be a list of room names")
+
+    calendar_client = get_calendar_client()
+    storage_client = get_storage_client()
+    watch_url=config.get("gcal_watch_function_url","")+"/webhook"
+    logger.info("Executing request to watch rooms "+", ".join(room_names))
+
+    def watch_one(room_name):
+        calendar_id = config.get_calendar_id(room_name)
+        if calendar_id=="":
+            return {"status":"error","error":"room not in configuration"}
+        try:
+            response = watch_room(calendar_client,storage_client,room_name,calendar_id,watch_url,save=False)
+            return {"status":"ok","channel_id":response.get("id",""),
+                    "expiration":response.get("expiration","")}
+        except Exception as e:
+            logger.error("Unable to watch calendar for "+room_name+": {}".format(e))
+            return {"status":"error","error":str(e)}
+
+    results={}
+    if room_names:
+        #channels may have been replaced by another instance since the last read
+        channel_manager.refresh()
+        with ThreadPoolExecutor(max_workers=min(WATCH_WORKERS,len(room_names))) as executor:
+            for room_name,result in zip(room_names,executor.map(watch_one,room_names)):
+                results[room_name]=result
+        #one write of the channel state for all the rooms
+        channel_manager.save()
+    return jsonify(results)
+
+
+@app.route('/renew_channels',methods=['POST'])
+def renew_channels():
+    content = request.get_json(True)
+    #read auth data from request
+    client_id = content.get("client_id","")
+    authh = request.headers.get("Authorization","Bearer ")
+    client_secret = authh[7:len(authh)]
+    if client_secret=="" or client_id=="":
+        abort(400,"Required parameters in request body are missing")
+
+    #retrieve config
+    config = config_cache.get()
+    config_client_id=config.get("iot_client_id","")
+    #allow only requests with the same client_id as the one configured
+    if client_id!=config_client_id:
+        abort(401,"ERROR - Client not authorized")
+
+    calendar_client = get_calendar_client()
+    watch_url=config.get("gcal_watch_function_url","")+"/webhook"
+    result = channel_manager.renew_due(calendar_client,config.calendar_by_room,watch_url)
+    logger.info("Renewed channels "+json.dumps(result))
+    return jsonify(result)
+
+
+@app.route('/channels',methods=['GET'])
+def channels_health():
+    config = authorize_get()
+    return jsonify(channel_manager.health(config.calendar_by_room))
+
+
 
 
 @app.route("/meeting/<id>",methods=['DELETE'])
@@ -234,32 +481,19 @@ def delete_meeting(id):
     if room_name=="" or client_secret=="" or client_id=="":
         abort(400,"Required parameters in request body are missing")
     
-    storage_client = storage.Client()
     #retrieve config
-    bucket = storage_client.bucket(CONFIG_BUCKET_NAME)
-    blob = bucket.blob("config.json")
-    with blob.open("r") as f:
-        config = json.load(f)
-    
-    config_client_id=config.get("iot_client_id","")
-    #allow only requests with the same client_id as the one configured
-    if client_id!=config_client_id:
-        abort(401,"ERROR - Client not authorized")
-    
-    rooms=config.get("rooms",[])
+    config = config_cache.get()
     config_client_id=config.get("iot_client_id","")
     #allow only requests with the same client_id as the one configured
     if client_id!=config_client_id:
         abort(401,"ERROR - Client not authorized")
 
-    calendar_id = ""
-    for room in rooms:
-        if room.get("room_name","")==room_name:
-            calendar_id=room.get("gcal_calendar_id","")
+    calendar_id = config.get_calendar_id(room_name)
 
     if calendar_id=="":
         abort(400,"Required parameter not matching configuration for room_name="+room_name)
 
+    from gcalclient import GCalClient
     gcalc = GCalClient(calendar_id,room_name)
 
     attempts=1
@@ -290,27 +524,19 @@ def new_meeting():
     if room_name=="" or client_secret=="" or client_id=="":
         abort(400,"Required parameters in request body are missing")
     
-    storage_client = storage.Client()
     #retrieve config
-    bucket = storage_client.bucket(CONFIG_BUCKET_NAME)
-    blob = bucket.blob("config.json")
-    with blob.open("r") as f:
-        config = json.load(f)
-    
-    rooms=config.get("rooms",[])
+    config = config_cache.get()
     config_client_id=config.get("iot_client_id","")
     #allow only requests with the same client_id as the one configured
     if client_id!=config_client_id:
         abort(401,"ERROR - Client not authorized")
 
-    calendar_id = ""
-    for room in rooms:
-        if room.get("room_name","")==room_name:
-            calendar_id=room.get("gcal_calendar_id","")
+    calendar_id = config.get_calendar_id(room_name)
 
     if calendar_id=="":
         abort(400,"Required parameter not matching configuration for room_name="+room_name)
 
+    from gcalclient import GCalClient
     gcalc = GCalClient(calendar_id,room_name)
 
     duration_mins = int(duration_str)
@@ -334,6 +560,28 @@ def new_meeting():
 
 
 
+def prewarm():
+    #imports the client libraries and builds the shared clients used by the
+    #webhook in background, so an instance started by a notification burst
+    #answers the first requests without paying for all of it in one request
+    start = time.time()
+    try:
+        get_storage_client()
+        get_calendar_client()
+        get_publisher()
+        import eventsync
+        config_cache.get()
+        logger.info("Prewarm done in secs="+str(round(time.time()-start,2)))
+    except Exception as e:
+        logger.error("Prewarm failed: {}".format(e))
+
+#GCALWATCH_PREWARM=0 disables it, e.g. when only measuring the import time
+if os.environ.get("GCALWATCH_PREWARM","1")!="0":
+    prewarm_thread = Thread(target=prewarm,daemon=True)
+    prewarm_thread.name = "prewarm"
+    prewarm_thread.start()
+
+
 if __name__ == '__main__':
     logger.info("Startup")
     
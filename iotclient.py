@@ -1,9 +1,6 @@
 
 from flask import jsonify
 
-from oauthlib.oauth2 import BackendApplicationClient
-from requests_oauthlib import OAuth2Session
-
 import iot_api_client as iot
 from iot_api_client.rest import ApiException
 from iot_api_client.configuration import Configuration
@@ -11,67 +8,61 @@ import iot_api_client.apis.tags.things_v2_api as thingApi
 import iot_api_client.apis.tags.properties_v2_api as propertiesApi
  
 import mylogger
-import time
+import metrics
+import tracing
+from threading import Lock
 from roomstatus import RoomStatus 
+from tokenmanager import TokenManager
+from thingindex import ThingIndex
+from ratelimiter import RateLimiter
 from time import sleep
 
 
 logger = mylogger.getlogger(__name__)
 
+RATE_WAIT = metrics.counter("roomcal_iot_rate_limit_wait_seconds_total","Time spent waiting on the IoT rate limiter")
+
 MAX_ATTEMPTS=3
-RETRY_DELAY_IOT=3  #avoids exceeding API rate limiting
+RETRY_DELAY_IOT=3  #delay between retries, also used when a 429 has no Retry-After
+POOL_MAXSIZE=10  #max parallel connections kept by the shared ApiClient
+STATUS_FIELDS=frozenset(RoomStatus.FIELD_NAMES)  #room status properties, named as the fields
  
 
 class IotClient:
     
-    PNAME_CUREVMSG = "curevmsg"
-    PNAME_BUSYNOW = "busynow"
-    PNAME_CUREVSTART="curevstart"
-    PNAME_CUREVEND="curevend"
-    PNAME_CUREVTM="curevtm"
-    PNAME_CUREVORGANIZER="curevorganizer"
-    PNAME_CUREVID="curevid"
-
-    PNAME_NEXTEVMSG="nextevmsg"
-    PNAME_NEXTEVSTART="nextevstart"
-    PNAME_NEXTEVTM="nextevtm"
-    PNAME_NEXTEVEND="nextevend"
-    PNAME_NEXTEVORGANIZER="nextevorganizer"
-    PNAME_NEXTEVID = "nextevid"
-            
     HOST = "https://api2.arduino.cc/iot"
     TOKEN_URL = "https://api2.arduino.cc/iot/v1/clients/token"
 
     client_id=""
     client_secret=""
     org_id=""
+
+    #long lived ApiClient (and its connection pool) per (client_id,org_id)
+    api_clients = {}
+    api_clients_lock = Lock()
     
 
-    def __init__(self,client_id,client_secret,org_id):
+    def __init__(self,client_id,client_secret,org_id,index_file="",rate_limit=None,rate_burst=None):
         self.client_id=client_id
         self.client_secret=client_secret
         self.org_id=org_id
+        self.token_manager=TokenManager.get_manager(self.TOKEN_URL,self.HOST,client_id,client_secret)
+        #room name -> thing id and property ids, optionally persisted in index_file
+        self.thing_index=ThingIndex.get_index((client_id,org_id),index_file)
+        #quota is per API client, so all rooms and threads share one bucket
+        self.limiter=RateLimiter.get_limiter(client_id,rate_limit,rate_burst)
 
 
     def get_token(self):
-        start = time.time()
-        oauth_client = BackendApplicationClient(client_id=self.client_id)
-        oauth = OAuth2Session(client=oauth_client)
-        token = oauth.fetch_token(
-            token_url=self.TOKEN_URL,
-            client_id=self.client_id,
-            client_secret=self.client_secret,
-            include_client_id=True,
-            audience=self.HOST
-        )
-        logger.debug("Token retrieval took secs=" +str(time.time()-start))
-        return token
+        #cached until shortly before expiry, see TokenManager
+        return self.token_manager.get_token()
 
 
     def init_client(self,token):
         # configure and instance the API client
         client_config = Configuration(host=self.HOST)
         client_config.access_token = token.get("access_token")
+        client_config.connection_pool_maxsize = POOL_MAXSIZE
         if self.org_id!="":
             client = iot.ApiClient(client_config,header_name="X-Organization",header_value=self.org_id)
         else :
@@ -79,92 +70,131 @@ class IotClient:
         return client
 
 
+    def get_client(self):
+        token = self.get_token()
+        key = (self.client_id,self.org_id)
+        with self.api_clients_lock:
+            client = self.api_clients.get(key)
+            if client is None:
+                client = self.init_client(token)
+                self.api_clients[key]=client
+            else:
+                #access token is read from configuration on every request
+                client.configuration.access_token = token.get("access_token")
+        return client
+
+
+    def call_api(self,func,*args,**kwargs):
+        #every IoT API request goes through the shared rate limiter
+        attempts = 1
+        while True:
+            RATE_WAIT.inc(self.limiter.acquire())
+            try:
+                with metrics.timed("iot",func.__name__):
+                    return func(*args,**kwargs)
+            except ApiException as e:
+                if getattr(e,"status",None)!=429 or attempts>=MAX_ATTEMPTS:
+                    raise
+                metrics.API_RETRIES.labels(api="iot",reason="rate_limited").inc()
+                self.limiter.backoff(self.get_retry_after(e))
+                attempts=attempts+1
+
+
+    def get_retry_after(self,e):
+        headers = getattr(e,"headers",None)
+        if headers:
+            try:
+                return float(headers.get("Retry-After",RETRY_DELAY_IOT))
+            except (TypeError,ValueError):
+                pass
+        return RETRY_DELAY_IOT
+
+
+    def get_rate_stats(self):
+        return self.limiter.stats()
+
+
+    def check_auth_error(self,e):
+        #token revoked or expired earlier than announced, refresh on next call
+        if getattr(e,"status",None)==401:
+            logger.info("IOTCLIENT: token rejected, invalidating")
+            self.token_manager.invalidate()
+
+
     def get_room_status_retry(self,room_name):
-        sleep(1)
         roomstatus_iot=self.get_room_status(room_name)
         attempts = 1
         while(roomstatus_iot.is_valid()==False and attempts<MAX_ATTEMPTS):
+            metrics.API_RETRIES.labels(api="iot",reason="invalid_status").inc()
             sleep(RETRY_DELAY_IOT)
             attempts=attempts+1
             roomstatus_iot=self.get_room_status(room_name)
+        if not roomstatus_iot.is_valid():
+            metrics.API_FAILURES.labels(api="iot",op="get_room_status").inc()
         return roomstatus_iot 
 
 
+    def list_things(self,things_api):
+        things = self.call_api(things_api.things_v2_list)
+        if things.response.status!=200:
+            logger.error("IoT API returned status "+str(things.response.status))
+            raise ApiException(status=things.response.status,reason="things_v2_list failed")
+        return things.body
+
+
     def get_room_status(self,room_name):
-        token = self.get_token()
-        client = self.init_client(token)
+        client = self.get_client()
         things_api = thingApi.ThingsV2Api(client)
         properties_api = propertiesApi.PropertiesV2Api(client)
         room=RoomStatus()
         properties=[]
         md={}    
         try:
-            things = things_api.things_v2_list()
-            sleep(RETRY_DELAY_IOT)
-            if things.response.status==200:
-                for thing in things.body: 
-                    if thing["name"] == room_name:
-                        logger.debug(f"Found thing: {thing}")
-                        room.name=room_name
-                        md["thingid"]=thing["id"]
-                        properties=properties_api.properties_v2_list(path_params={'id': thing["id"]})  
-                room.valid=True
-            else:
-                logger.error("IoT API returned status "+things.response.status)
+            md = self.thing_index.lookup(room_name,lambda: self.list_things(things_api))
+            if md is None:
+                #didn't find any thing with this room name
+                logger.info(f"Did not find thing corresponding to room: {room_name}")
                 room.valid=False
+                return room
+            try:
+                properties=self.call_api(properties_api.properties_v2_list,path_params={'id': md["thingid"]})
+            except ApiException as e:
+                if getattr(e,"status",None)!=404:
+                    raise
+                #thing was deleted or recreated since it was indexed
+                logger.info(f"Thing for room {room_name} not found, refreshing index")
+                self.thing_index.invalidate(room_name)
+                md = self.thing_index.lookup(room_name,lambda: self.list_things(things_api))
+                if md is None:
+                    logger.info(f"Did not find thing corresponding to room: {room_name}")
+                    room.valid=False
+                    return room
+                properties=self.call_api(properties_api.properties_v2_list,path_params={'id': md["thingid"]})
+            room.name=room_name
+            room.valid=True
         except ApiException as e:
             room.valid=False 
+            self.check_auth_error(e)
             logger.error("IOTCLIENT: Exception in get room status: {}".format(e))
             return room
 
-        if room.name!=room_name:
-            #didn't find any thing with this room name
-            logger.info(f"Did not find thing corresponding to room: {room_name}")
-            room.valid=False
-            return room
-
         #creates cache of property ids
         #in addition to copying variables in room object
+        md={"thingid":md["thingid"]}
         for property in properties.body:
-            #print(property)
-            md[property["name"]]=property["id"]
-            value = property["last_value"]
-            if value is None:
-                value = ""
-            if property["name"]==self.PNAME_CUREVMSG:
-                room.curevmsg=value
-            if property["name"]==self.PNAME_BUSYNOW:
-                room.busynow=value
-            if property["name"]==self.PNAME_CUREVSTART:
-                room.curevstart=value
-            if property["name"]==self.PNAME_CUREVEND:
-                room.curevend=value
-            if property["name"]==self.PNAME_CUREVTM:
-                room.curevtm=value
-            if property["name"]==self.PNAME_CUREVORGANIZER:
-                room.curevorganizer=value
-            if property["name"]==self.PNAME_CUREVID:
-                room.curevid=value    
-            if property["name"]==self.PNAME_NEXTEVMSG:
-                room.nextevmsg=value
-            if property["name"]==self.PNAME_NEXTEVSTART:
-                room.nextevstart=value
-            if property["name"]==self.PNAME_NEXTEVTM:
-                room.nextevtm=value
-            if property["name"]==self.PNAME_NEXTEVEND:
-                room.nextevend=value
-            if property["name"]==self.PNAME_NEXTEVORGANIZER:
-                room.nextevorganizer=value
-            if property["name"]==self.PNAME_NEXTEVID:
-                room.nextevid=value    
+            name = property["name"]
+            md[name]=property["id"]
+            if name in STATUS_FIELDS:
+                value = property["last_value"]
+                setattr(room,name,"" if value is None else value)
         room.metadata=md
+        self.thing_index.set_metadata(room_name,md)
 
         return room
 
 
     def update_room_status(self,newstatus,current):
-        token = self.get_token()
-        client = self.init_client(token)
+        client = self.get_client()
         properties_api = propertiesApi.PropertiesV2Api(client)
         
         tid = current.metadata.get("thingid","")
@@ -173,72 +203,27 @@ class IotClient:
             return
         
         try:
-            if current.curevmsg!=newstatus.curevmsg:
-                self.update_property(properties_api,current,newstatus,tid,self.PNAME_CUREVMSG)
-            if current.curevstart!=newstatus.curevstart:
-                self.update_property(properties_api,current,newstatus,tid,self.PNAME_CUREVSTART)
-            if current.curevend!=newstatus.curevend:
-                self.update_property(properties_api,current,newstatus,tid,self.PNAME_CUREVEND)
-            if current.curevtm!=newstatus.curevtm:
-                self.update_property(properties_api,current,newstatus,tid,self.PNAME_CUREVTM)
-            if current.curevorganizer!=newstatus.curevorganizer:
-                self.update_property(properties_api,current,newstatus,tid,self.PNAME_CUREVORGANIZER)
-            if current.curevid!=newstatus.curevid:
-                self.update_property(properties_api,current,newstatus,tid,self.PNAME_CUREVID)
-            if current.nextevmsg!=newstatus.nextevmsg:
-                self.update_property(properties_api,current,newstatus,tid,self.PNAME_NEXTEVMSG)
-            if current.nextevstart!=newstatus.nextevstart:
-                self.update_property(properties_api,current,newstatus,tid,self.PNAME_NEXTEVSTART)
-            if current.nextevend!=newstatus.nextevend:
-                self.update_property(properties_api,current,newstatus,tid,self.PNAME_NEXTEVEND)
-            if current.nextevtm!=newstatus.nextevtm:
-                self.update_property(properties_api,current,newstatus,tid,self.PNAME_NEXTEVTM) 
-            if current.nextevorganizer!=newstatus.nextevorganizer:
-                self.update_property(properties_api,current,newstatus,tid,self.PNAME_NEXTEVORGANIZER)
-            if current.nextevid!=newstatus.nextevid:
-                self.update_property(properties_api,current,newstatus,tid,self.PNAME_NEXTEVID)
-            if current.busynow!=newstatus.busynow:
-                self.update_property(properties_api,current,newstatus,tid,self.PNAME_BUSYNOW)
+            #only the properties that differ, see RoomStatus.FIELD_NAMES for the order
+            for pname in current.diff(newstatus):
+                self.update_property(properties_api,current,newstatus,tid,pname)
 
         except ApiException as e:
+            self.check_auth_error(e)
             logger.error("IOTCLIENT: Error in update_room_status: {}".format(e))
 
 
 
     def update_property(self,properties_api,current,newstatus,tid,pname):
         pid = current.metadata.get(pname,"")
-        if (pname == self.PNAME_BUSYNOW):
-            value = newstatus.busynow
-        if (pname == self.PNAME_CUREVMSG):
-            value = newstatus.curevmsg
-        if (pname == self.PNAME_CUREVSTART):
-            value = newstatus.curevstart
-        if (pname == self.PNAME_CUREVEND):
-            value = newstatus.curevend
-        if (pname == self.PNAME_CUREVTM):
-            value = newstatus.curevtm
-        if (pname == self.PNAME_CUREVORGANIZER):
-            value = newstatus.curevorganizer
-        if (pname == self.PNAME_CUREVID):
-            value = newstatus.curevid
-        if (pname == self.PNAME_NEXTEVMSG):
-            value = newstatus.nextevmsg
-        if (pname == self.PNAME_NEXTEVSTART):
-            value = newstatus.nextevstart
-        if (pname == self.PNAME_NEXTEVEND):
-            value = newstatus.nextevend
-        if (pname == self.PNAME_NEXTEVTM):
-            value = newstatus.nextevtm
-        if (pname == self.PNAME_NEXTEVORGANIZER):
-            value = newstatus.nextevorganizer
-        if (pname == self.PNAME_NEXTEVID):
-            value = newstatus.nextevid
-        try:
-            logger.info("UPDATE: "+tid+"/"+pid+"/"+pname+"="+str(value))
-            params = dict()
-            params["id"]=tid
-            params["pid"]=pid
-            properties_api.properties_v2_publish( path_params=params, body={'value':value} )
-            sleep(1)
-        except ApiException as e:
-            logger.error("IOTCLIENT: Error in update_property: {}".format(e))
+        value = getattr(newstatus,pname)
+        with tracing.span("iot.properties_v2_publish",**{"iot.thing_id":tid,"iot.property":pname}) as span:
+            try:
+                logger.info("UPDATE: "+tid+"/"+pid+"/"+pname+"="+str(value)+" trace="+span.trace_id)
+                params = dict()
+                params["id"]=tid
+                params["pid"]=pid
+                self.call_api(properties_api.properties_v2_publish, path_params=params, body={'value':value} )
+            except ApiException as e:
+                self.check_auth_error(e)
+                span.set_error(e)
+                logger.error("IOTCLIENT: Error in update_property: {}".format(e))
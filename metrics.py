@@ -0,0 +1,326 @@
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler,ThreadingHTTPServer
+from threading import Lock,Thread
+import time
+import urllib.parse
+import mylogger
+
+logger = mylogger.getlogger(__name__)
+
+#minimal in-process metrics exposed in Prometheus text format, no client
+#library or collector needed: gcalwatch serves them on /metrics, updater on
+#its own small HTTP server (see start_http_server)
+CONTENT_TYPE="text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS=(0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30,60,120,300)
+
+
+def format_value(value):
+    if value==float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def format_labels(names,values):
+    if not names:
+        return ""
+    pairs=[]
+    for name,value in zip(names,values):
+        value = str(value).replace("\\","\\\\").replace("\n","\\n").replace('"','\\"')
+        pairs.append(name+'="'+value+'"')
+    return "{"+",".join(pairs)+"}"
+
+
+class Metric:
+
+    kind="untyped"
+
+    def __init__(self,name,documentation,labelnames=()):
+        self.name=name
+        self.documentation=documentation
+        self.labelnames=tuple(labelnames)
+        self.lock=Lock()
+        self.children={}
+        if not self.labelnames:
+            self.children[()]=self.new_child()
+
+
+    def labels(self,**labels):
+        key = tuple(str(labels.get(name,"")) for name in self.labelnames)
+        with self.lock:
+            child = self.children.get(key)
+            if child is None:
+                child = self.new_child()
+                self.children[key]=child
+            return child
+
+
+    def child(self):
+        #the metric without labels
+        return self.children[()]
+
+
+    def render(self):
+        lines = ["# HELP "+self.name+" "+self.documentation,"# TYPE "+self.name+" "+self.kind]
+        with self.lock:
+            children = list(self.children.items())
+        for key,child in sorted(children):
+            lines.extend(child.render(self.name,self.labelnames,key))
+        return lines
+
+
+class CounterChild:
+
+    def __init__(self):
+        self.lock=Lock()
+        self.value=0.0
+
+
+    def inc(self,amount=1):
+        with self.lock:
+            self.value=self.value+amount
+
+
+    def render(self,name,labelnames,key):
+        return [name+format_labels(labelnames,key)+" "+format_value(self.value)]
+
+
+class Counter(Metric):
+
+    kind="counter"
+
+    def new_child(self):
+        return CounterChild()
+
+
+    def inc(self,amount=1):
+        self.child().inc(amount)
+
+
+class GaugeChild:
+
+    def __init__(self):
+        self.lock=Lock()
+        self.value=0.0
+        self.function=None
+
+
+    def set(self,value):
+        with self.lock:
+            self.value=value
+
+
+    def set_function(self,function):
+        #value is read when metrics are rendered
+        self.function=function
+
+
+    def get(self):
+        if self.function is not None:
+            try:
+                return self.function()
+            except Exception as e:
+                logger.error("Unable to read gauge: {}".format(e))
+                return float("nan")
+        return self.value
+
+
+    def render(self,name,labelnames,key):
+        value = self.get()
+        text = "NaN" if value!=value else format_value(value)
+        return [name+format_labels(labelnames,key)+" "+text]
+
+
+class Gauge(Metric):
+
+    kind="gauge"
+
+    def new_child(self):
+        return GaugeChild()
+
+
+    def set(self,value):
+        self.child().set(value)
+
+
+    def set_function(self,function):
+        self.child().set_function(function)
+
+
+class HistogramChild:
+
+    def __init__(self,buckets):
+        self.lock=Lock()
+        self.buckets=buckets
+        self.counts=[0]*len(buckets)
+        self.count=0
+        self.sum=0.0
+
+
+    def observe(self,value):
+        with self.lock:
+            for i,bound in enumerate(self.buckets):
+                if value<=bound:
+                    self.counts[i]=self.counts[i]+1
+                    break
+            self.count=self.count+1
+            self.sum=self.sum+value
+
+
+    @contextmanager
+    def time(self):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic()-start)
+
+
+    def render(self,name,labelnames,key):
+        with self.lock:
+            counts = list(self.counts)
+            count = self.count
+            total = self.sum
+        lines=[]
+        cumulative=0
+        for bound,bucket_count in zip(self.buckets,counts):
+            cumulative=cumulative+bucket_count
+            lines.append(name+"_bucket"+format_labels(labelnames+("le",),key+(format_value(bound),))
+                         +" "+str(cumulative))
+        lines.append(name+"_bucket"+format_labels(labelnames+("le",),key+("+Inf",))+" "+str(count))
+        lines.append(name+"_sum"+format_labels(labelnames,key)+" "+format_value(total))
+        lines.append(name+"_count"+format_labels(labelnames,key)+" "+str(count))
+        return lines
+
+
+class Histogram(Metric):
+
+    kind="histogram"
+
+    def __init__(self,name,documentation,labelnames=(),buckets=DEFAULT_BUCKETS):
+        self.buckets=tuple(sorted(buckets))
+        Metric.__init__(self,name,documentation,labelnames)
+
+
+    def new_child(self):
+        return HistogramChild(self.buckets)
+
+
+    def observe(self,value):
+        self.child().observe(value)
+
+
+    def time(self):
+        return self.child().time()
+
+
+class Registry:
+
+    def __init__(self):
+        self.lock=Lock()
+        self.metrics={}
+
+
+    def register(self,metric):
+        #registering the same name again returns the existing metric, so
+        #modules can declare the metrics they use at import time
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self.metrics[metric.name]=metric
+            return metric
+
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines=[]
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines)+"\n"
+
+
+registry = Registry()
+
+
+def counter(name,documentation,labelnames=()):
+    return registry.register(Counter(name,documentation,labelnames))
+
+
+def gauge(name,documentation,labelnames=()):
+    return registry.register(Gauge(name,documentation,labelnames))
+
+
+def histogram(name,documentation,labelnames=(),buckets=DEFAULT_BUCKETS):
+    return registry.register(Histogram(name,documentation,labelnames,buckets))
+
+
+def render():
+    return registry.render()
+
+
+#calls to external APIs, api is one of calendar, iot, gcs, pubsub
+API_CALLS = counter("roomcal_api_calls_total","Calls to external APIs",("api","op","outcome"))
+API_DURATION = histogram("roomcal_api_call_duration_seconds","Duration of calls to external APIs",("api","op"))
+API_RETRIES = counter("roomcal_api_retries_total","Calls to external APIs that were retried",("api","reason"))
+API_FAILURES = counter("roomcal_api_failures_total","Operations given up after retries",("api","op"))
+
+
+@contextmanager
+def timed(api,op):
+    #counts and times a call, outcome is error when it raises
+    start = time.monotonic()
+    outcome = "ok"
+    try:
+        yield
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        API_DURATION.labels(api=api,op=op).observe(time.monotonic()-start)
+        API_CALLS.labels(api=api,op=op,outcome=outcome).inc()
+
+
+#path -> (content type, function(params) returning the body), see add_route
+routes = {"/metrics":(CONTENT_TYPE,lambda params: render())}
+
+
+def add_route(path,content_type,function):
+    #other process state served next to the metrics, e.g. tracing spans
+    routes[path]=(content_type,function)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        path = "/metrics" if url.path=="/" else url.path
+        if path not in routes:
+            self.send_error(404)
+            return
+        content_type,function = routes[path]
+        params = dict(urllib.parse.parse_qsl(url.query))
+        body = function(params).encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type",content_type)
+        self.send_header("Content-Length",str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self,format,*args):
+        #scrapes are not logged
+        return
+
+
+def start_http_server(port,addr="127.0.0.1"):
+    #serves /metrics from a daemon thread, returns the server
+    server = ThreadingHTTPServer((addr,port),MetricsHandler)
+    server.daemon_threads=True
+    thread = Thread(target=server.serve_forever,daemon=True)
+    thread.name = "metrics_server"
+    thread.start()
+    logger.info("Serving metrics on port "+str(server.server_address[1]))
+    return server
@@ -0,0 +1,94 @@
+from threading import Lock
+from time import sleep
+import time
+import mylogger
+
+logger = mylogger.getlogger(__name__)
+
+DEFAULT_RATE=2.0   #requests per second
+DEFAULT_BURST=5    #requests allowed back to back after an idle period
+
+
+class RateLimiter:
+
+    #one token bucket per API account, shared by all clients and threads
+    limiters = {}
+    limiters_lock = Lock()
+
+    @classmethod
+    def get_limiter(cls,key,rate=None,burst=None):
+        #None keeps the current setting of an existing limiter (defaults for
+        #a new one), so clients built without explicit rates do not reset it
+        with cls.limiters_lock:
+            limiter = cls.limiters.get(key)
+            if limiter is None:
+                limiter = RateLimiter(rate,burst)
+                cls.limiters[key]=limiter
+            elif rate is not None or burst is not None:
+                with limiter.lock:
+                    limiter.configure(rate if rate is not None else limiter.rate,
+                                      burst if burst is not None else limiter.burst)
+            return limiter
+
+
+    def __init__(self,rate=DEFAULT_RATE,burst=DEFAULT_BURST):
+        self.lock=Lock()
+        self.configure(rate,burst)
+        self.tokens=float(self.burst)
+        self.updated_at=time.monotonic()
+        self.blocked_until=0
+        self.calls=0
+        self.throttled=0
+        self.waited_total=0.0
+        self.waited_max=0.0
+
+
+    def configure(self,rate,burst):
+        self.rate=float(rate) if rate and rate>0 else DEFAULT_RATE
+        self.burst=max(1,int(burst)) if burst else DEFAULT_BURST
+
+
+    def refill(self,now):
+        self.tokens=min(self.burst,self.tokens+(now-self.updated_at)*self.rate)
+        self.updated_at=now
+
+
+    def acquire(self):
+        #blocks until a request can be sent, returns the secs waited
+        start=time.monotonic()
+        while True:
+            with self.lock:
+                now=time.monotonic()
+                self.refill(now)
+                if now<self.blocked_until:
+                    delay=self.blocked_until-now
+                elif self.tokens>=1:
+                    self.tokens=self.tokens-1
+                    waited=now-start
+                    self.calls=self.calls+1
+                    self.waited_total=self.waited_total+waited
+                    self.waited_max=max(self.waited_max,waited)
+                    return waited
+                else:
+                    delay=(1-self.tokens)/self.rate
+            sleep(delay)
+
+
+    def backoff(self,secs):
+        #server said we are over quota, hold every caller for secs
+        with self.lock:
+            now=time.monotonic()
+            self.throttled=self.throttled+1
+            self.blocked_until=max(self.blocked_until,now+secs)
+            self.tokens=0
+        logger.info("Rate limited by server, backing off secs="+str(secs))
+
+
+    def stats(self):
+        with self.lock:
+            return {
+                "calls":self.calls,
+                "throttled":self.throttled,
+                "waited_total":self.waited_total,
+                "waited_max":self.waited_max
+            }
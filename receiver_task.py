@@ -1,10 +1,12 @@
 
 from time import sleep
 from datetime import datetime, timezone
-import os
 import mylogger
-import json
 from calendarmap import CalendarMap
+from timeline import EventTimeline
+from wireformat import decode_room_events,get_version,get_notified_at
+import metrics
+import tracing
 from google.auth import default 
 from google.cloud import pubsub_v1
 from google.oauth2 import service_account
@@ -13,27 +15,56 @@ from google.oauth2 import service_account
 SCOPES = ['https://www.googleapis.com/auth/pubsub']
 
 global calendar_map
-global newdata_cond
 
 logger = mylogger.getlogger(__name__)
 
+MESSAGES = metrics.counter("roomcal_pubsub_messages_received_total","Room events messages received",("outcome",))
+DELIVERY = metrics.histogram("roomcal_pubsub_delivery_seconds","From publish to receipt of room events messages")
+
 
 def callback(message):
-    global calendar_map
-    global newdata_cond
     #read and ack message
-    data = message.data.decode('utf-8')
     message.ack()
-    #copy events in calendarmap
-    obj = json.loads(data)
-    room_name=obj["room_name"]
-    logger.info(f"Received message: {room_name}")
-    calendar_map.acquireLock()
-    calendar_map.setCalendar(room_name,obj["events"])
+    #continues the trace started by the gcalwatch webhook
+    parent = tracing.SpanContext.from_traceparent(message.attributes.get(tracing.ATTR_TRACEPARENT))
+    with tracing.span("receive",parent,**{"gcal.message_number":message.attributes.get("message_number","")}) as span:
+        outcome = apply_message(message)
+        span.set_attribute("outcome",outcome)
+    MESSAGES.labels(outcome=outcome).inc()
+
+
+def apply_message(message):
+    #returns what was done with the message
+    global calendar_map
+    try:
+        DELIVERY.observe(max(0,datetime.now(timezone.utc).timestamp()-message.publish_time.timestamp()))
+    except Exception:
+        pass
+    try:
+        room_name,rows = decode_room_events(message.data,message.attributes)
+    except Exception as e:
+        logger.error("Unable to decode message: {}".format(e))
+        return "invalid"
+    version = get_version(message.attributes)
+    span = tracing.current()
+    span.set_attribute("room",room_name)
+    span.set_attribute("version",version or 0)
+    logger.info(f"Received message: {room_name} events={len(rows)} bytes={len(message.data)} version={version} trace={span.trace_id}")
+    #compile events in calendarmap
+    timeline = EventTimeline(rows)
+    #swaps the room snapshot, never waits on IoT calls of the updater
+    applied = calendar_map.setTimeline(room_name,timeline,version)
+    if not applied:
+        #delivered out of order, a newer snapshot is already in use
+        logger.info(f"Dropping stale events for room {room_name} version={version}")
+        return "stale"
+    notified_at = get_notified_at(message.attributes)
+    if notified_at is not None:
+        calendar_map.setNotifiedAt(room_name,notified_at)
+    calendar_map.setTrace(room_name,span.context())
     calendar_map.pushWakeup(CalendarMap.REASON_CALENDARCHANGE,room_name)
-    calendar_map.releaseLock()
-    with newdata_cond:
-        newdata_cond.notify_all()
+    return "applied"
+
     
 def get_credentials():
     #using local credential just for testing, not recommended
@@ -45,10 +76,8 @@ def get_credentials():
     return creds
 
 
-def receiver_task(cm,cond):
+def receiver_task(cm):
     global calendar_map
-    global newdata_cond
-    newdata_cond=cond
     calendar_map=cm
     logger.info("Initializing receiver thread")
     
@@ -67,14 +96,11 @@ def receiver_task(cm,cond):
             sleep(60-current_seconds)
             current_time = datetime.now()
             logger.info("SEND wake up REGULAR!")
-            calendar_map.acquireLock()
-            calendar_map.pushWakeup(CalendarMap.REASON_REGULAR,"")
-            calendar_map.releaseLock()
-            with newdata_cond:
-                newdata_cond.notify_all()
+            #at most one REGULAR tick is pending, ticks missed during a slow cycle are coalesced
+            if not calendar_map.pushWakeup(CalendarMap.REASON_REGULAR,""):
+                logger.info("Previous REGULAR wake up still pending")
         except Exception as e:
             logger.error(e)
-            calendar_map.releaseLock()        
             sleep(5)
             #try to reconnect in case it was a problem with pubsub
             subscriber = pubsub_v1.SubscriberClient(credentials=creds)
@@ -1,57 +1,80 @@
+from operator import attrgetter
 import json
 
 class RoomStatus:
-    
+
     BUSY=1
-    FREE=0                        
+    FREE=0
+
+    #what the room device shows; each field is kept in the IoT Cloud
+    #property of the same name and they are written in this order, busynow
+    #last so the device switches state once the event details are in place
+    FIELD_NAMES=("curevmsg","curevstart","curevend","curevtm","curevorganizer","curevid",
+                 "nextevmsg","nextevstart","nextevend","nextevtm","nextevorganizer","nextevid",
+                 "busynow")
+
+    #name is compared too, metadata (thing and property ids) and valid are not
+    __slots__=("name",)+FIELD_NAMES+("metadata","valid")
+
 
-    
     def __init__(self):
         self.name="unknown"
-        self.busynow=self.FREE 
-        self.curevmsg = "unknown" 
-        self.curevend ="" 
-        self.curevstart ="" 
-        self.curevtm =""
-        self.nextevmsg = ""
+        self.curevmsg="unknown"
+        self.curevstart=""
+        self.curevend=""
+        self.curevtm=""
+        self.curevorganizer=""
+        self.curevid=""
+        self.nextevmsg=""
         self.nextevstart=""
-        self.nextevtm = ""
         self.nextevend=""
-        self.curevorganizer=""
+        self.nextevtm=""
         self.nextevorganizer=""
-        self.curevid=""
         self.nextevid=""
+        self.busynow=self.FREE
         self.metadata={}
         self.valid=False
-    
+
+
+    def diff(self,other):
+        #fields whose value differs from other, in FIELD_NAMES (write) order
+        return [field for field,value,other_value in zip(self.FIELD_NAMES,field_values(self),field_values(other))
+                if value!=other_value]
+
+
+    def as_dict(self):
+        return {slot:getattr(self,slot) for slot in self.__slots__}
+
+
+    @classmethod
+    def from_dict(cls,values):
+        #keys that are not fields of the status are ignored
+        status = cls()
+        for k,v in values.items():
+            if k in cls.__slots__:
+                setattr(status,k,v)
+        return status
+
 
     def toJSON(self):
-        return json.dumps(self.__dict__)
+        return json.dumps(self.as_dict())
 
 
     def is_valid(self):
         return self.valid
- 
 
-    def __str__(self): 
-        return self.__dict__.__str__()
+
+    def __str__(self):
+        return self.as_dict().__str__()
 
 
     def __eq__(self, other):
+        if other is self:
+            return True
         if isinstance(other, self.__class__):
-            return self.name==other.name \
-                and self.busynow==other.busynow \
-                and self.curevmsg==other.curevmsg \
-                and self.curevstart==other.curevstart \
-                and self.curevend==other.curevend \
-                and self.curevtm==other.curevtm \
-                and self.curevid==other.curevid \
-                and self.nextevtm==other.nextevtm \
-                and self.nextevstart==other.nextevstart \
-                and self.nextevend==other.nextevend \
-                and self.nextevmsg==other.nextevmsg \
-                and self.nextevid == other.nextevid \
-                and self.curevorganizer==other.curevorganizer \
-                and self.nextevorganizer==other.nextevorganizer
+            return self.name==other.name and field_values(self)==field_values(other)
         else:
             return False
+
+
+field_values = attrgetter(*RoomStatus.FIELD_NAMES)
@@ -0,0 +1,64 @@
+from threading import Lock
+from datetime import datetime,timezone
+import heapq
+import time
+import mylogger
+
+logger = mylogger.getlogger(__name__)
+
+
+class TransitionScheduler:
+
+    def __init__(self):
+        #min-heap of (due, room_name, generation), stale entries are skipped on pop
+        self.heap=[]
+        self.due={}
+        self.generations={}
+        self.lock=Lock()
+
+
+    def schedule(self,room_name,due,replace=False,now=None):
+        #replace also moves an earlier wakeup later, except one already due at
+        #now (first tick, retries); checked under the lock, so a concurrent
+        #wake is never overwritten
+        with self.lock:
+            current = self.due.get(room_name)
+            if current is not None:
+                if not replace and current<=due:
+                    return
+                if replace and now is not None and current<=now:
+                    return
+            generation = self.generations.get(room_name,0)+1
+            self.generations[room_name]=generation
+            self.due[room_name]=due
+            heapq.heappush(self.heap,(due,room_name,generation))
+
+
+    def plan(self,room_name,timeline,now=None):
+        #called whenever the events of a room change
+        if now is None:
+            now = time.time()
+        due = timeline.next_transition(now)
+        #a wakeup that is already due is kept, processing the room re-plans
+        self.schedule(room_name,due,replace=True,now=now)
+        logger.debug("Room "+room_name+" next transition at "+datetime.fromtimestamp(due,timezone.utc).isoformat())
+
+
+    def wake(self,room_name,delay=0):
+        #process room at the next tick after delay, e.g. to retry a failed update
+        self.schedule(room_name,time.time()+delay)
+
+
+    def pop_due(self,now=None):
+        if now is None:
+            now = time.time()
+        rooms=[]
+        with self.lock:
+            while self.heap and self.heap[0][0]<=now:
+                due,room_name,generation = heapq.heappop(self.heap)
+                if self.generations.get(room_name)!=generation:
+                    continue
+                del self.due[room_name]
+                rooms.append(room_name)
+        return rooms
+
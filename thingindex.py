@@ -0,0 +1,141 @@
+from threading import Lock
+import json
+import os
+import time
+import mylogger
+
+logger = mylogger.getlogger(__name__)
+
+INDEX_TTL=6*3600  #full things listing is redone after this many secs
+MIN_REFRESH_INTERVAL=60  #limits listings triggered by names that have no thing
+
+
+class ThingIndex:
+
+    #one index per (client_id,org_id), shared by all IotClient instances
+    indexes = {}
+    indexes_lock = Lock()
+
+    @classmethod
+    def get_index(cls,key,path="",ttl=INDEX_TTL):
+        with cls.indexes_lock:
+            index = cls.indexes.get(key)
+            if index is None:
+                index = ThingIndex(path,ttl)
+                cls.indexes[key]=index
+            return index
+
+
+    def __init__(self,path="",ttl=INDEX_TTL):
+        self.path=path
+        self.ttl=ttl
+        #room_name -> metadata dict, "thingid" plus property name -> property id
+        self.entries={}
+        self.refreshed_at=0
+        self.lock=Lock()
+        self.refresh_lock=Lock()
+        if self.path!="":
+            self.load()
+
+
+    def is_expired(self):
+        return time.time()>self.refreshed_at+self.ttl
+
+
+    def get(self,room_name):
+        if self.is_expired():
+            return None
+        with self.lock:
+            md = self.entries.get(room_name)
+            if md is None:
+                return None
+            return dict(md)
+
+
+    def lookup(self,room_name,list_things):
+        #returns the metadata for room_name, listing all things only on a miss
+        #or when the index is older than its ttl
+        md = self.get(room_name)
+        if md is not None:
+            return md
+        self.refresh(list_things)
+        with self.lock:
+            md = self.entries.get(room_name)
+            return dict(md) if md is not None else None
+
+
+    def refresh(self,list_things):
+        with self.refresh_lock:
+            #somebody else refreshed while we were waiting
+            if not self.is_expired() and time.time()<self.refreshed_at+MIN_REFRESH_INTERVAL:
+                return
+            things = list_things()
+            with self.lock:
+                entries={}
+                for thing in things:
+                    old = self.entries.get(thing["name"],{})
+                    if old.get("thingid")==thing["id"]:
+                        entries[thing["name"]]=old
+                    else:
+                        entries[thing["name"]]={"thingid":thing["id"]}
+                self.entries=entries
+                self.refreshed_at=time.time()
+            logger.info("Thing index refreshed, things="+str(len(entries)))
+            self.save()
+
+
+    def set_metadata(self,room_name,md):
+        with self.lock:
+            if self.entries.get(room_name)==md:
+                return
+            self.entries[room_name]=dict(md)
+        self.save()
+
+
+    def invalidate(self,room_name):
+        #the thing was deleted or recreated, next lookup does a full listing
+        with self.lock:
+            self.entries.pop(room_name,None)
+            self.refreshed_at=0
+
+
+    def snapshot(self):
+        with self.lock:
+            return self.refreshed_at,{name:dict(md) for name,md in self.entries.items()}
+
+
+    def restore(self,refreshed_at,entries):
+        #used by a warm start, kept only if newer than what is already loaded
+        with self.lock:
+            if refreshed_at<=self.refreshed_at:
+                return
+            self.entries=entries
+            self.refreshed_at=refreshed_at
+        self.save()
+
+
+    def load(self):
+        try:
+            with open(self.path,"r") as f:
+                content = json.load(f)
+            self.entries=content.get("entries",{})
+            self.refreshed_at=content.get("refreshed_at",0)
+            logger.info("Loaded thing index from "+self.path+", things="+str(len(self.entries)))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error("Unable to load thing index: {}".format(e))
+
+
+    def save(self):
+        if self.path=="":
+            return
+        with self.lock:
+            content = { "refreshed_at":self.refreshed_at, "entries":self.entries }
+            try:
+                tmppath = self.path+".tmp"
+                with open(tmppath,"w") as f:
+                    json.dump(content,f)
+                os.replace(tmppath,self.path)
+            except Exception as e:
+                logger.error("Unable to save thing index: {}".format(e))
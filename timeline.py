@@ -0,0 +1,172 @@
+from bisect import bisect_right
+from datetime import datetime,timezone,timedelta
+from roomstatus import RoomStatus
+import time
+import mylogger
+
+logger = mylogger.getlogger(__name__)
+
+
+def parse_event_time(value):
+    #all day events only have a date, they start at midnight UTC
+    if "T" in value:
+        return datetime.strptime(value,"%Y-%m-%dT%H:%M:%S%z")
+    return datetime.strptime(value,"%Y-%m-%d").replace(tzinfo=timezone.utc)
+
+
+def next_midnight(now):
+    #"Free until" / "Free all day" and next event formats change at midnight UTC
+    day = datetime.fromtimestamp(now,timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    return (day+timedelta(days=1)).timestamp()
+
+
+def compact_event(event):
+    #reduces a Calendar API event to the fields used to compute room status:
+    #(id, summary, start, end, declined, organizer)
+    start = event['start'].get('dateTime', event['start'].get('date'))
+    end = event['end'].get('dateTime', event['end'].get('date'))
+    declined = False
+    organizer = ""
+    for attendee in event.get('attendees',[]):
+        #attendee with key 'self' is the owner of this calendar
+        if 'self' in attendee:
+            declined = attendee.get('responseStatus','')=='declined'
+        if attendee.get("organizer") is True:
+            organizer = attendee.get("email","")
+    summary = event.get("summary","Private Meeting")
+    return (event.get('id',''),summary,start,end,declined,organizer)
+
+
+class EventTimeline:
+
+    #per event, index aligned arrays; formatted strings are computed once here
+    #so that a status lookup is a bisect plus a few field copies
+
+    def __init__(self,rows=()):
+        parsed=[]
+        for row in rows:
+            try:
+                startd = parse_event_time(row[2])
+                endd = parse_event_time(row[3])
+            except (TypeError,ValueError) as e:
+                logger.error("Skipping event {}: {}".format(row[0],e))
+                continue
+            parsed.append((startd.timestamp(),endd.timestamp(),startd,endd,row))
+        parsed.sort(key=lambda p: p[0])
+
+        self.rows=[p[4] for p in parsed]
+        self.starts=[p[0] for p in parsed]
+        self.ends=[p[1] for p in parsed]
+        self.declined=[p[4][4] for p in parsed]
+        self.ids=[p[4][0] for p in parsed]
+        self.summaries=[p[4][1] for p in parsed]
+        self.organizers=[p[4][5] for p in parsed]
+        self.hm_start=[datetime.strftime(p[2],"%H:%M") for p in parsed]
+        self.hm_end=[datetime.strftime(p[3],"%H:%M") for p in parsed]
+        self.multiday=[datetime.strftime(p[2],"%Y-%m-%d")!=datetime.strftime(p[3],"%Y-%m-%d") for p in parsed]
+        self.md_start=[datetime.strftime(p[2],"%b %d") for p in parsed]
+        self.md_end=[datetime.strftime(p[3],"%b %d") for p in parsed]
+        self.full_start=[datetime.strftime(p[2],"%Y-%m-%d %H:%M") for p in parsed]
+        self.long_start=[datetime.strftime(p[2],"%a %d %b %H:%M") for p in parsed]
+
+        #lookups only consider accepted events
+        self.accepted=[i for i in range(len(parsed)) if not self.declined[i]]
+        self.accepted_starts=[self.starts[i] for i in self.accepted]
+        self.accepted_ends=sorted(self.ends[i] for i in self.accepted)
+        #running max of end times in start order: the first accepted event
+        #still in progress or upcoming at t is at bisect_right(max_ends,t)
+        self.max_ends=[]
+        running=float("-inf")
+        for i in self.accepted:
+            running=max(running,self.ends[i])
+            self.max_ends.append(running)
+
+
+    @classmethod
+    def from_events(cls,events):
+        rows=[]
+        for event in events or []:
+            try:
+                rows.append(compact_event(event))
+            except (KeyError,AttributeError) as e:
+                logger.error("Skipping malformed event: {}".format(e))
+        return cls(rows)
+
+
+    def __len__(self):
+        return len(self.rows)
+
+
+    def next_transition(self,now):
+        #first instant after now where the status can change
+        result = next_midnight(now)
+        pos = bisect_right(self.accepted_starts,now)
+        if pos<len(self.accepted_starts):
+            result = min(result,self.accepted_starts[pos])
+        pos = bisect_right(self.accepted_ends,now)
+        if pos<len(self.accepted_ends):
+            result = min(result,self.accepted_ends[pos])
+        return result
+
+
+    def set_nextev(self,i,tomorrow,result):
+        #if it's within the day use only H:M otherwise put day in front
+        result.nextevmsg = self.summaries[i]
+        result.nextevorganizer = self.organizers[i]
+        result.nextevid = self.ids[i]
+        if self.starts[i]<tomorrow:
+            result.nextevstart = self.hm_start[i]
+            result.nextevend = self.hm_end[i]
+            result.nextevtm = result.nextevstart+"-"+result.nextevend
+        elif self.multiday[i]:
+            result.nextevstart = self.md_start[i]
+            result.nextevend = self.md_end[i]
+            result.nextevtm = result.nextevstart+"-"+result.nextevend
+        else:
+            result.nextevstart = self.full_start[i]
+            result.nextevend = self.hm_end[i]
+            result.nextevtm = self.long_start[i]+"-"+result.nextevend
+
+
+    def status_at(self,room_name,now=None):
+        if now is None:
+            now = time.time()
+        result = RoomStatus()
+        result.valid = True
+        result.name = room_name
+
+        pos = bisect_right(self.max_ends,now)
+        if pos>=len(self.accepted):
+            logger.debug('No upcoming events found.')
+            return result
+        first = self.accepted[pos]
+        tomorrow = next_midnight(now)
+
+        if self.starts[first]<now:
+            #first event will tell if room is busy
+            result.busynow = RoomStatus.BUSY
+            result.curevmsg = self.summaries[first]
+            result.curevorganizer = self.organizers[first]
+            result.curevid = self.ids[first]
+            if self.multiday[first]:
+                #multi-day event in progress, the current day is fully busy
+                result.curevstart = self.md_start[first]
+                result.curevend = self.md_end[first]
+            else:
+                result.curevstart = self.hm_start[first]
+                result.curevend = self.hm_end[first]
+            result.curevtm = result.curevstart+"-"+result.curevend
+            #second event is the next meeting, skipping events already over
+            for k in range(pos+1,len(self.accepted)):
+                second = self.accepted[k]
+                if self.ends[second]>now:
+                    self.set_nextev(second,tomorrow,result)
+                    break
+        else:
+            result.busynow = RoomStatus.FREE
+            if self.starts[first]<tomorrow:
+                result.curevmsg = "Free until "+self.hm_start[first]
+            else:
+                result.curevmsg = "Free all day"
+            self.set_nextev(first,tomorrow,result)
+        return result
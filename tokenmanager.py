@@ -0,0 +1,84 @@
+from threading import Lock
+from oauthlib.oauth2 import BackendApplicationClient
+from requests_oauthlib import OAuth2Session
+import mylogger
+import metrics
+import time
+
+logger = mylogger.getlogger(__name__)
+
+#refresh the token this many seconds before it expires
+REFRESH_MARGIN=60
+#used when the token endpoint does not return expires_in
+DEFAULT_EXPIRES_IN=300
+
+
+class TokenManager:
+
+    #one manager per (token_url,client_id), shared by all IotClient instances
+    managers = {}
+    managers_lock = Lock()
+
+    @classmethod
+    def get_manager(cls,token_url,audience,client_id,client_secret):
+        key=(token_url,client_id)
+        with cls.managers_lock:
+            manager = cls.managers.get(key)
+            if manager is None or manager.client_secret!=client_secret:
+                manager = TokenManager(token_url,audience,client_id,client_secret)
+                cls.managers[key]=manager
+            return manager
+
+
+    def __init__(self,token_url,audience,client_id,client_secret):
+        self.token_url=token_url
+        self.audience=audience
+        self.client_id=client_id
+        self.client_secret=client_secret
+        self.token=None
+        self.expires_at=0
+        self.refreshes=0
+        #held only while fetching, so concurrent callers wait for a single refresh
+        self.refresh_lock=Lock()
+
+
+    def is_fresh(self):
+        return self.token is not None and time.time()<self.expires_at-REFRESH_MARGIN
+
+
+    def get_token(self):
+        token = self.token
+        if self.is_fresh():
+            return token
+        with self.refresh_lock:
+            #another thread may have refreshed while we were waiting
+            if not self.is_fresh():
+                self.fetch_token()
+            return self.token
+
+
+    def invalidate(self):
+        #forces a refresh on next use, e.g. after a 401 from the API
+        with self.refresh_lock:
+            self.expires_at=0
+
+
+    def fetch_token(self):
+        start = time.time()
+        oauth_client = BackendApplicationClient(client_id=self.client_id)
+        oauth = OAuth2Session(client=oauth_client)
+        with metrics.timed("iot","fetch_token"):
+            token = oauth.fetch_token(
+                token_url=self.token_url,
+                client_id=self.client_id,
+                client_secret=self.client_secret,
+                include_client_id=True,
+                audience=self.audience
+            )
+        expires_in = token.get("expires_in",DEFAULT_EXPIRES_IN)
+        self.expires_at = start+float(expires_in)
+        self.token = token
+        self.refreshes = self.refreshes+1
+        logger.debug("Token retrieval took secs=" +str(time.time()-start))
+        logger.info("IoT token refreshed, expires in secs="+str(expires_in))
+        return token
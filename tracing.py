@@ -0,0 +1,215 @@
+from collections import deque
+from contextlib import contextmanager
+from threading import Lock,local
+import json
+import os
+import random
+import time
+import mylogger
+
+logger = mylogger.getlogger(__name__)
+
+#span records correlating a calendar notification with the iotcloud writes it
+#causes: gcalwatch starts a trace for each webhook and passes it to updater in
+#the W3C traceparent attribute of the Pub/Sub message. Finished spans are kept
+#in memory (served by /traces) and, if TRACE_EXPORT_FILE is set, appended to
+#that file as OTLP JSON lines (one ExportTraceServiceRequest per line), which
+#the OpenTelemetry collector otlpjsonfile receiver can read
+ATTR_TRACEPARENT="traceparent"
+MAX_SPANS=2000  #finished spans kept in memory
+SCOPE_NAME="roomcalendar"
+
+STATUS_UNSET=0
+STATUS_OK=1
+STATUS_ERROR=2
+
+
+def new_trace_id():
+    return "%032x" % random.getrandbits(128)
+
+
+def new_span_id():
+    return "%016x" % random.getrandbits(64)
+
+
+class SpanContext:
+
+    def __init__(self,trace_id,span_id):
+        self.trace_id=trace_id
+        self.span_id=span_id
+
+
+    def to_traceparent(self):
+        return "00-"+self.trace_id+"-"+self.span_id+"-01"
+
+
+    @staticmethod
+    def from_traceparent(value):
+        #None if missing or malformed
+        parts = (value or "").split("-")
+        if len(parts)!=4 or len(parts[1])!=32 or len(parts[2])!=16:
+            return None
+        return SpanContext(parts[1],parts[2])
+
+
+def otlp_value(value):
+    if isinstance(value,bool):
+        return {"boolValue":value}
+    if isinstance(value,int):
+        return {"intValue":str(value)}
+    if isinstance(value,float):
+        return {"doubleValue":value}
+    return {"stringValue":str(value)}
+
+
+def otlp_attributes(attributes):
+    return [{"key":k,"value":otlp_value(v)} for k,v in attributes.items()]
+
+
+class Span:
+
+    def __init__(self,tracer,name,trace_id,parent_id="",attributes=None):
+        self.tracer=tracer
+        self.name=name
+        self.trace_id=trace_id
+        self.span_id=new_span_id()
+        self.parent_id=parent_id
+        self.attributes=dict(attributes or {})
+        self.start_ns=time.time_ns()
+        self.end_ns=None
+        self.status=STATUS_UNSET
+        self.status_message=""
+
+
+    def context(self):
+        return SpanContext(self.trace_id,self.span_id)
+
+
+    def set_attribute(self,key,value):
+        self.attributes[key]=value
+
+
+    def set_error(self,message):
+        self.status=STATUS_ERROR
+        self.status_message=str(message)
+
+
+    def end(self):
+        if self.end_ns is not None:
+            return
+        self.end_ns=time.time_ns()
+        self.tracer.record(self)
+
+
+    def duration_ms(self):
+        end = self.end_ns if self.end_ns is not None else time.time_ns()
+        return (end-self.start_ns)/1000000.0
+
+
+    def to_otlp(self):
+        span = {
+            "traceId":self.trace_id,
+            "spanId":self.span_id,
+            "name":self.name,
+            "kind":1,  #internal
+            "startTimeUnixNano":str(self.start_ns),
+            "endTimeUnixNano":str(self.end_ns),
+            "attributes":otlp_attributes(self.attributes),
+            "status":{"code":self.status}
+        }
+        if self.parent_id!="":
+            span["parentSpanId"]=self.parent_id
+        if self.status_message!="":
+            span["status"]["message"]=self.status_message
+        return span
+
+
+class Tracer:
+
+    def __init__(self,service_name="roomcalendar",export_file=None,max_spans=MAX_SPANS):
+        self.service_name=service_name
+        self.export_file=export_file if export_file is not None else os.environ.get("TRACE_EXPORT_FILE","")
+        self.spans=deque(maxlen=max_spans)
+        self.lock=Lock()
+        self.current_spans=local()
+
+
+    def configure(self,service_name=None,export_file=None):
+        if service_name is not None:
+            self.service_name=service_name
+        if export_file is not None:
+            self.export_file=export_file
+
+
+    def current(self):
+        return getattr(self.current_spans,"span",None)
+
+
+    def start_span(self,name,parent=None,attributes=None):
+        #parent is a Span or SpanContext, defaults to the current span of this
+        #thread; without any a new trace is started
+        if parent is None:
+            parent = self.current()
+        if parent is None:
+            return Span(self,name,new_trace_id(),"",attributes)
+        return Span(self,name,parent.trace_id,parent.span_id,attributes)
+
+
+    @contextmanager
+    def span(self,name,parent=None,**attributes):
+        #span that is the current one of this thread until the block exits
+        span = self.start_span(name,parent,attributes)
+        previous = self.current()
+        self.current_spans.span=span
+        try:
+            yield span
+        except BaseException as e:
+            span.set_error(e)
+            raise
+        finally:
+            self.current_spans.span=previous
+            span.end()
+
+
+    def record(self,span):
+        with self.lock:
+            self.spans.append(span)
+            if self.export_file=="":
+                return
+            try:
+                with open(self.export_file,"a") as f:
+                    f.write(json.dumps(self.export([span]),separators=(",",":"))+"\n")
+            except Exception as e:
+                logger.error("Unable to export span: {}".format(e))
+
+
+    def finished(self,trace_id=None):
+        with self.lock:
+            return [s for s in self.spans if trace_id is None or s.trace_id==trace_id]
+
+
+    def export(self,spans):
+        #OTLP JSON ExportTraceServiceRequest
+        return {"resourceSpans":[{
+            "resource":{"attributes":otlp_attributes({"service.name":self.service_name})},
+            "scopeSpans":[{"scope":{"name":SCOPE_NAME},"spans":[s.to_otlp() for s in spans]}]
+        }]}
+
+
+    def render(self,trace_id=None):
+        return json.dumps(self.export(self.finished(trace_id)))
+
+
+tracer = Tracer()
+
+
+def span(name,parent=None,**attributes):
+    return tracer.span(name,parent,**attributes)
+
+
+def start_span(name,parent=None,attributes=None):
+    return tracer.start_span(name,parent,attributes)
+
+
+def current():
+    return tracer.current()
@@ -1,9 +1,14 @@
-from threading import Thread,Condition
+from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
 import json
 import mylogger
-from time import sleep
+import metrics
+import tracing
+from time import sleep,time
 from receiver_task import receiver_task
 from calendarmap import CalendarMap
+from scheduler import TransitionScheduler
+from checkpoint import Checkpoint,CHECKPOINT_INTERVAL
 from gcalclient import GCalClient
 from datetime import datetime
 from iotclient import IotClient
@@ -26,6 +31,18 @@ SCOPES = ['https://www.googleapis.com/auth/pubsub',
 
 MAX_ATTEMPTS=3
 RETRY_DELAY_IOT=1
+PROPAGATION_POLL_DELAY=0.5  #first wait before re-reading a property that was not yet updated
+PROPAGATION_TIMEOUT=5  #max secs to wait for written properties to be read back
+ROOM_WORKERS=4  #rooms processed in parallel on each tick, 1 processes them sequentially
+RETRY_DELAY_ROOM=50  #rooms that failed to sync are processed again on the next tick
+METRICS_PORT=9090  #metrics served at http://host:port/metrics, 0 disables
+METRICS_ADDR="127.0.0.1"  #local scrapes only, "" or "0.0.0.0" serves on all interfaces
+
+PROPAGATION = metrics.histogram("roomcal_propagation_seconds",
+                                "From calendar change notification to room status in sync in iotcloud",("room",))
+TICK_DURATION = metrics.histogram("roomcal_tick_duration_seconds","Time to process the rooms due at a tick")
+ROOMS_PROCESSED = metrics.counter("roomcal_rooms_processed_total","Rooms processed by regular ticks")
+ROOM_FAILURES = metrics.counter("roomcal_room_failures_total","Rooms that could not be brought in sync at a tick")
  
 def start_watching_calendar(client_id,client_secret,room_name,watchurl):
     logger.info("Start watching calendar "+room_name)
@@ -41,6 +58,56 @@ def start_watching_calendar(client_id,client_secret,room_name,watchurl):
         logger.error(e)
     return
  
+def start_watching_calendars(client_id,client_secret,room_names,watchallurl,watchurl):
+    #one request watches all rooms in parallel, rooms that failed (or all of them
+    #if the bulk request fails) fall back to a request per room
+    logger.info("Start watching calendars of "+str(len(room_names))+" rooms")
+    headers={"Authorization":"Bearer "+client_secret}
+    data = {'room_names': room_names, 'client_id': client_id}
+    failed = room_names
+    try:
+        response = requests.post(watchallurl, json=data,headers=headers)
+        response.raise_for_status()
+        results = response.json()
+        failed = [room_name for room_name in room_names
+                  if results.get(room_name,{}).get("status","")!="ok"]
+    except requests.RequestException as e:
+        logger.error("Error occurred during bulk watch request: {}".format(e))
+    except Exception as e:
+        logger.error(e)
+    for room_name in failed:
+        start_watching_calendar(client_id,client_secret,room_name,watchurl)
+    return
+
+
+def wait_for_propagation(iotc,room_name,expected):
+    #written values are usually readable right away, so poll with a growing
+    #delay instead of sleeping the worst case propagation time
+    delay = PROPAGATION_POLL_DELAY
+    deadline = time()+PROPAGATION_TIMEOUT
+    while True:
+        iot_room_status = iotc.get_room_status_retry(room_name)
+        if (iot_room_status.is_valid() and iot_room_status==expected) or time()+delay>deadline:
+            return iot_room_status
+        sleep(delay)
+        delay = delay*2
+
+
+def renew_watch_channels(client_id,client_secret,renewurl):
+    #gcalwatch renews the notification channels that are close to expiry
+    logger.info("Renewing calendar watch channels")
+    headers={"Authorization":"Bearer "+client_secret}
+    try:
+        response = requests.post(renewurl, json={'client_id': client_id},headers=headers)
+        response.raise_for_status()
+        logger.info("Channels renewal: "+response.text)
+    except requests.RequestException as e:
+        logger.error("Error occurred during channels renewal: {}".format(e))
+    except Exception as e:
+        logger.error(e)
+    return
+
+
 def update_if_needed(iotc,room_name,iot_room_status,gcal_room_status):
     if gcal_room_status.is_valid() and iot_room_status.is_valid() and gcal_room_status != iot_room_status:
             #need to update roomstatus in iot
@@ -48,20 +115,112 @@ def update_if_needed(iotc,room_name,iot_room_status,gcal_room_status):
             updateok = False
             while not updateok and attempts<MAX_ATTEMPTS:
                 logger.info(f"Updating room {room_name} in IoTCloud...")
-                iotc.update_room_status(gcal_room_status,iot_room_status)
-                #leave some time for property propagation
-                sleep(5)
-                iot_room_status = iotc.get_room_status_retry(room_name) 
+                with tracing.span("iot_write",attempt=attempts):
+                    iotc.update_room_status(gcal_room_status,iot_room_status)
+                with tracing.span("verify",attempt=attempts) as span:
+                    iot_room_status = wait_for_propagation(iotc,room_name,gcal_room_status)
+                    span.set_attribute("in_sync",iot_room_status.is_valid() and iot_room_status==gcal_room_status)
                 logger.debug(gcal_room_status)
                 logger.debug(iot_room_status)
                 if iot_room_status.is_valid() and iot_room_status==gcal_room_status:
                     updateok = True
                 else:
                     logger.info("Retrying update, still not OK "+str(iot_room_status.is_valid()))
+                    metrics.API_RETRIES.labels(api="iot",reason="update_not_applied").inc()
                     attempts=attempts+1
             if not updateok:
                 logger.info("Unable to perform update after multiple attempts, stopping")
-    return 
+                metrics.API_FAILURES.labels(api="iot",op="update_room_status").inc()
+            return updateok
+    return True
+
+def process_room(cm,iotc,room_name):
+    #continues the trace of the last events received for the room, if any,
+    #otherwise the room is processed by a tick and a new trace is started
+    parent = cm.popTrace(room_name)
+    trigger = "tick" if parent is None else "notification"
+    with tracing.span("process_room",parent,room=room_name,trigger=trigger) as span:
+        updated = sync_room(cm,iotc,room_name)
+        span.set_attribute("in_sync",updated)
+        return updated
+
+
+def sync_room(cm,iotc,room_name):
+    with tracing.span("compute_status"):
+        gcal_room_status = cm.getTimeline(room_name).status_at(room_name)
+    logger.debug(gcal_room_status)
+    if not gcal_room_status.is_valid():
+        logger.error("Could not retrieve valid calendar status for room "+room_name)
+        return False
+    with tracing.span("iot_read"):
+        iot_room_status = iotc.get_room_status_retry(room_name)
+    logger.debug(iot_room_status)
+    if not iot_room_status.is_valid():
+        logger.error("Could not retrieve valid iotcloud status for room "+room_name)
+        return False
+    #all valid, check for update
+    if not update_if_needed(iotc,room_name,iot_room_status,gcal_room_status):
+        return False
+    cm.setLastStatus(room_name,gcal_room_status)
+    notified_at = cm.popNotifiedAt(room_name)
+    if notified_at is not None:
+        #from the calendar change notification to iotcloud in sync
+        PROPAGATION.labels(room=room_name).observe(max(0,time()-notified_at))
+    return True
+
+
+def process_rooms(cm,iotc,room_names,executor=None):
+    #rooms are independent, so they can be handled by a bounded pool of workers;
+    #the IoT rate limiter shared by the workers keeps the total within quota
+    #returns the rooms that could not be brought in sync
+    start = time()
+    rate_before = iotc.get_rate_stats()
+    failed=[]
+    ROOMS_PROCESSED.inc(len(room_names))
+    if executor is None:
+        for room_name in room_names:
+            if not process_room(cm,iotc,room_name):
+                failed.append(room_name)
+    else:
+        futures = [executor.submit(process_room,cm,iotc,room_name) for room_name in room_names]
+        for room_name,future in zip(room_names,futures):
+            try:
+                if not future.result():
+                    failed.append(room_name)
+            except Exception as e:
+                logger.error("Error processing room "+room_name+": {}".format(e))
+                failed.append(room_name)
+    rate_after = iotc.get_rate_stats()
+    TICK_DURATION.observe(time()-start)
+    ROOM_FAILURES.inc(len(failed))
+    logger.info("Tick processed rooms="+str(len(room_names))+" in secs="+str(round(time()-start,2))
+                +" iot_calls="+str(rate_after["calls"]-rate_before["calls"])
+                +" rate_wait_secs="+str(round(rate_after["waited_total"]-rate_before["waited_total"],2)))
+    return failed
+
+
+def download_calendars(cm,calendars,incremental):
+    #stamped like gcalwatch messages, so a notification fetched
+    #before this download cannot overwrite it
+    events_version = int(time()*1000000)
+    room_events = GCalClient.get_next_events_batch(calendars,incremental)
+    for room_name in calendars:
+        cm.setCalendar(room_name,room_events.get(room_name,[]),events_version)
+
+
+def warm_reconcile(cm,calendars,incremental,watch_args):
+    #after a warm start, events are downloaded and calendars watched in
+    #background, then every room is reconciled at the next tick
+    try:
+        download_calendars(cm,calendars,incremental)
+        logger.info("Warm start, calendars downloaded")
+    except Exception as e:
+        logger.error("Unable to download calendars after warm start: {}".format(e))
+    for room_name in calendars:
+        cm.scheduler.wake(room_name)
+    cm.pushWakeup(CalendarMap.REASON_REGULAR,"")
+    start_watching_calendars(*watch_args)
+
 
 def get_credentials():
     #using local credential just for testing, not recommended
@@ -90,96 +249,116 @@ def watch_and_update_iot():
     client_id=config.get("iot_client_id","")
     org_id=config.get("iot_organization_id","")
     gcal_watchurl=config.get("gcal_watch_function_url","")+"/start_watching"
-    iotc=IotClient(client_id,client_secret,org_id)
+    gcal_watchallurl=config.get("gcal_watch_function_url","")+"/start_watching_all"
+    gcal_renewurl=config.get("gcal_watch_function_url","")+"/renew_channels"
+    thing_index_file=config.get("iot_thing_index_file","")
+    iotc=IotClient(client_id,client_secret,org_id,thing_index_file,
+                   config.get("iot_rate_limit_rps"),config.get("iot_rate_limit_burst"))
+
+    tracing.tracer.configure(service_name="updater",export_file=config.get("trace_file"))
+    metrics_port = int(config.get("metrics_port",METRICS_PORT))
+    if metrics_port>0:
+        metrics.add_route("/traces","application/json",lambda params: tracing.tracer.render(params.get("trace_id")))
+        metrics.start_http_server(metrics_port,config.get("metrics_addr",METRICS_ADDR))
 
     cm = CalendarMap()
+    #plans for each room the next instant its status can change
+    scheduler = TransitionScheduler()
+    cm.scheduler = scheduler
+
+    room_workers = int(config.get("room_workers",ROOM_WORKERS))
+    executor = None
+    if room_workers>1:
+        executor = ThreadPoolExecutor(max_workers=room_workers,thread_name_prefix="room_worker")
     
+    incremental = config.get("gcal_incremental_sync",True)
     rooms = config.get("rooms",[])
     logger.info("Starting to watch calendar for all rooms...")
     room_names=[]
+    calendars={}
     for room in rooms:
-        #prepares client and downloads events for the first population
         calendar_id = room.get("gcal_calendar_id","")
         room_name = room.get("room_name","")
         room_names.append(room_name)
-        calendar_client=GCalClient(calendar_id,room_name)
-        events = calendar_client.get_next_events()
-        cm.setCalendar(room_name,events)
+        calendars[room_name]=calendar_id
         cm.setCalendarId(room_name,calendar_id)
-        start_watching_calendar(client_id,client_secret,room_name,gcal_watchurl)
+    watch_args = [client_id,client_secret,room_names,gcal_watchallurl,gcal_watchurl]
+    checkpoint = None
+    checkpoint_interval = config.get("checkpoint_interval_secs",CHECKPOINT_INTERVAL)
+    restored = []
+    if config.get("checkpoint_file","")!="":
+        mirror = storage_client if config.get("checkpoint_mirror",False) else None
+        checkpoint = Checkpoint(config["checkpoint_file"],mirror,BUCKET_NAME)
+        restored = checkpoint.restore(cm,iotc.thing_index,calendars)
+    if restored:
+        #warm start: serves from the checkpoint right away, only rooms whose status
+        #changed since it was last written are processed before the background
+        #download completes; rooms not in the checkpoint wait for the download
+        for room_name in restored:
+            if cm.getTimeline(room_name).status_at(room_name)!=cm.getLastStatus(room_name):
+                scheduler.wake(room_name)
+        reconcile_thread = Thread(target=warm_reconcile,args=[cm,calendars,incremental,watch_args])
+        reconcile_thread.name = "warm_reconcile"
+        reconcile_thread.start()
+    else:
+        #downloads events for the first population
+        download_calendars(cm,calendars,incremental)
+        for room_name in room_names:
+            #first tick reconciles every room with iotcloud
+            scheduler.wake(room_name)
+        start_watching_calendars(*watch_args)
 
-    #used to get notified by the receiver thread
-    newdata_cond = Condition()
     #start separate thread to receive notification messages that update events
     logger.info("Starting a thread to receive notifications...")    
-    thread = Thread(target=receiver_task, args=[cm,newdata_cond])
+    thread = Thread(target=receiver_task, args=[cm])
     thread.name = "notification_receiver"
     thread.start()
     sleep(1)
 
     while True:
         try:
-            with newdata_cond:
-                # Wait until data is available
-                newdata_cond.wait()
-                cm.acquireLock()
-                # WAKEUP call received from receiver_task, now Process the data
-                #pop out all calls which happened (can be multiple)
-                done_processing = False
-                while not done_processing:
-                    wakeupcall=cm.popWakeup()
-                    if "reason" in wakeupcall:
-                        logger.info("WAKEUP>"+wakeupcall["reason"]+".."+wakeupcall["calendar_name"])
-                        if wakeupcall["reason"]==cm.REASON_CALENDARCHANGE:
-                            #process calendar based on already received events
-                            room_name = wakeupcall["calendar_name"]
-                            calendar_client=GCalClient(calendar_id,room_name)
-                            events = cm.getCalendar(room_name)
-                            gcal_room_status = calendar_client.get_calendar_status_from_events(events)
-                            logger.debug(gcal_room_status)
-                            iot_room_status = iotc.get_room_status_retry(room_name)
-                            logger.debug(iot_room_status)
-                            if not iot_room_status.is_valid():
-                                logger.error("Could not retrieve valid iotcloud status for room "+room_name)
-                            else:
-                                #all valid, check for update
-                                update_if_needed(iotc,room_name,iot_room_status,gcal_room_status)
-                            
-                        
-                        if wakeupcall["reason"]==cm.REASON_REGULAR:
-                            #if we are at min 55 of the hour, to be sure about sync, re-downloads events from calendar
-                            current_time = datetime.now()
-                            current_mins = current_time.minute
-                            if current_mins==55:
-                                logger.info("Downloading room calendars for extra sync before hour end")
-                                for room_name in room_names:
-                                    calendar_client=GCalClient(cm.getCalendarId(room_name),room_name)
-                                    events = calendar_client.get_next_events()                        
-                                    cm.setCalendar(room_name,events)
-
-
-                            #process all calendars to see if since the time is different there is a different status
-                            for room_name in room_names:
-                                calendar_client=GCalClient(cm.getCalendarId(room_name),room_name)
-                                events = cm.getCalendar(room_name)
-                                gcal_room_status = calendar_client.get_calendar_status_from_events(events)
-                                logger.debug(gcal_room_status)
-                                iot_room_status = iotc.get_room_status_retry(room_name)
-                                logger.debug(iot_room_status)
-                                if not gcal_room_status.is_valid():
-                                    logger.error("Could not retrieve valid calendar status for room "+room_name)
-                                elif not iot_room_status.is_valid():
-                                    logger.error("Could not retrieve valid iotcloud status for room "+room_name)
-                                else:
-                                    #all valid, check for update
-                                    update_if_needed(iotc,room_name,iot_room_status,gcal_room_status)
-                    else :
-                        done_processing=True
-                cm.releaseLock()
+            # Wait until a WAKEUP call is received from receiver_task, then process it;
+            # wakeups for the same room (or REGULAR ticks) that pile up meanwhile are coalesced
+            wakeupcall=cm.popWakeup(block=True)
+            if "reason" not in wakeupcall:
+                continue
+            logger.info("WAKEUP>"+wakeupcall["reason"]+".."+wakeupcall["calendar_name"])
+            if wakeupcall["reason"]==cm.REASON_CALENDARCHANGE:
+                #process calendar based on already received events
+                process_room(cm,iotc,wakeupcall["calendar_name"])
                 
+            if wakeupcall["reason"]==cm.REASON_REGULAR:
+                logger.info("Wakeup queue "+str(cm.wakeup_events.stats())+" lock "+str(cm.getLockStats()))
+                #if we are at min 55 of the hour, to be sure about sync, re-downloads events from calendar
+                #and reconciles all rooms; otherwise only rooms with a status transition due are processed
+                current_time = datetime.now()
+                current_mins = current_time.minute
+                if current_mins==55:
+                    logger.info("Downloading room calendars for extra sync before hour end")
+                    download_calendars(cm,calendars,incremental)
+                    due_rooms = room_names
+                    #channels expire after some days, renew them ahead of time in background
+                    renew_thread = Thread(target=renew_watch_channels,args=[client_id,client_secret,gcal_renewurl])
+                    renew_thread.name = "channel_renewal"
+                    renew_thread.start()
+                    scheduler.pop_due()
+                else:
+                    due_rooms = scheduler.pop_due()
+
+                if due_rooms:
+                    failed = process_rooms(cm,iotc,due_rooms,executor)
+                    for room_name in due_rooms:
+                        cm.replan(room_name)
+                    for room_name in failed:
+                        scheduler.wake(room_name,RETRY_DELAY_ROOM)
+
+                if checkpoint is not None and checkpoint.is_due(checkpoint_interval):
+                    checkpoint_thread = Thread(target=checkpoint.save,args=[cm,iotc.thing_index,calendars])
+                    checkpoint_thread.name = "checkpoint"
+                    checkpoint_thread.start()
+            
         except Exception as e:
             logger.error(e)
-            cm.releaseLock()
             sleep(60) #try to see if with a delay it can be retried
  
 
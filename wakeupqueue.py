@@ -0,0 +1,56 @@
+from collections import OrderedDict
+from threading import Condition
+
+
+class WakeupQueue:
+
+    #FIFO work queue holding at most one pending wakeup per (reason, calendar):
+    #pushing a wakeup that is already pending is coalesced into it, a wakeup
+    #pushed after the pending one was popped is queued again
+
+    def __init__(self):
+        self.pending=OrderedDict()
+        self.cond=Condition()
+        self.pushed=0
+        self.coalesced=0
+        self.popped=0
+
+
+    def push(self,reason,calendar_name):
+        #returns False if the wakeup was coalesced into a pending one
+        key=(reason,calendar_name)
+        with self.cond:
+            if key in self.pending:
+                self.coalesced=self.coalesced+1
+                return False
+            self.pending[key]={ "reason": reason, "calendar_name":calendar_name}
+            self.pushed=self.pushed+1
+            self.cond.notify()
+            return True
+
+
+    def pop(self,block=False,timeout=None):
+        #oldest pending wakeup, or {} if none (after timeout when blocking)
+        with self.cond:
+            if block:
+                self.cond.wait_for(lambda: len(self.pending)>0,timeout)
+            if not self.pending:
+                return {}
+            key,wakeup = self.pending.popitem(last=False)
+            self.popped=self.popped+1
+            return wakeup
+
+
+    def depth(self):
+        with self.cond:
+            return len(self.pending)
+
+
+    def stats(self):
+        with self.cond:
+            return {
+                "depth":len(self.pending),
+                "pushed":self.pushed,
+                "coalesced":self.coalesced,
+                "popped":self.popped
+            }
@@ -0,0 +1,60 @@
+import json
+import zlib
+from timeline import compact_event
+
+#room events message published by gcalwatch and received by updater
+#schema 1 payload: {"v":1,"room":room_name,"ev":[[id,summary,start,end,declined,organizer],...]}
+#only the fields needed to compute room status are sent, see timeline.compact_event
+SCHEMA_VERSION="1"
+ATTR_SCHEMA="schema"
+ATTR_ENCODING="encoding"
+ATTR_VERSION="version"  #fetch time of the events in microseconds, orders snapshots of a room
+ATTR_NOTIFIED="notified_at"  #webhook receipt time in microseconds, for end to end latency
+ENCODING_ZLIB="zlib"
+COMPRESS_THRESHOLD=1024  #bytes, smaller payloads are sent uncompressed
+
+
+def encode_room_events(room_name,events,version=None,compress_threshold=COMPRESS_THRESHOLD):
+    #returns message data and attributes
+    rows = [list(compact_event(event)) for event in events]
+    payload = {"v":int(SCHEMA_VERSION),"room":room_name,"ev":rows}
+    data = json.dumps(payload,separators=(",",":")).encode('utf-8')
+    attributes = {ATTR_SCHEMA:SCHEMA_VERSION}
+    if version is not None:
+        attributes[ATTR_VERSION]=str(version)
+    if len(data)>compress_threshold:
+        data = zlib.compress(data)
+        attributes[ATTR_ENCODING]=ENCODING_ZLIB
+    return data,attributes
+
+
+def get_version(attributes):
+    #None for messages published without a version
+    try:
+        return int(attributes.get(ATTR_VERSION,""))
+    except (TypeError,ValueError):
+        return None
+
+
+def get_notified_at(attributes):
+    #seconds since epoch, None for messages published without it
+    try:
+        return int(attributes.get(ATTR_NOTIFIED,""))/1000000.0
+    except (TypeError,ValueError):
+        return None
+
+
+def decode_room_events(data,attributes=None):
+    #returns room name and compact event rows
+    if attributes is None:
+        attributes = {}
+    if attributes.get(ATTR_ENCODING,"")==ENCODING_ZLIB:
+        data = zlib.decompress(data)
+    obj = json.loads(data.decode('utf-8'))
+    schema = attributes.get(ATTR_SCHEMA,"")
+    if schema=="":
+        #messages published before the compact schema carry raw events
+        return obj["room_name"],[compact_event(event) for event in obj["events"]]
+    if schema!=SCHEMA_VERSION:
+        raise ValueError("Unsupported room events schema "+schema)
+    return obj["room"],[tuple(row) for row in obj["ev"]]